@@ -0,0 +1,901 @@
+#!/usr/bin/env python3
+"""
+Micro benchmarks for the storage and ingest code paths.
+
+$ ./Benchmark.py store-pool --rows 2000 --requests 500
+$ ./Benchmark.py exif /path/to/sample/images
+$ ./Benchmark.py hash --size-mb 2048
+$ ./Benchmark.py generate --rows 100000 /tmp/library
+$ ./Benchmark.py read-path --library /tmp/library --json results.json
+$ ./Benchmark.py ingest --files 200 --tool-latency convert=0.2
+"""
+import argparse
+from contextlib import contextmanager, redirect_stdout
+import datetime
+import hashlib
+import io
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+import zlib
+
+import Config
+from ExifUtils import ExifToolProcess
+from HashLib import (
+        hash_sha256,
+        hash_sha256_mmap,
+)
+from Metadata import (
+        ExifApi,
+        Store,
+        fill_tag_tables,
+)
+import Metrics
+from StorePool import StorePool
+import Thumbnail
+from Utils import (
+        check_output,
+        now,
+)
+
+@contextmanager
+def quiet():
+    """Keep trace() output from drowning the results"""
+    logging.disable(logging.INFO)
+    try:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+@contextmanager
+def scratch_dir():
+    path = tempfile.mkdtemp(prefix="file-browser-bench-")
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path)
+
+@contextmanager
+def library_dir(path):
+    """Runs with path as the working directory, where the relative paths in
+    Config.py point"""
+    cwd = os.getcwd()
+    os.makedirs(path, exist_ok=True)
+    os.chdir(path)
+    try:
+        for directory in [Config.upload_dir, Config.thumbnail_dir]:
+            os.makedirs(directory, exist_ok=True)
+        yield
+    finally:
+        os.chdir(cwd)
+
+def timed(fn, repeat):
+    """Returns seconds per call of fn"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+def report(name, per_call, baseline=None):
+    line = "%-32s %10.1f us/call" % (name, per_call * 1e6)
+    if baseline:
+        line += "   %6.1fx faster" % (baseline / per_call)
+    print(line)
+
+def fill_store(store, rows):
+    ts = now()
+    with store.batch():
+        for i in range(rows):
+            store.metadata.insert(
+                    fname="IMG_%06d.jpg" % i,
+                    hash_sha256="%064x" % i,
+                    time_db_added=ts,
+                    time_db_updated=ts,
+                    deleted=False,
+                    desc="",
+                    exif={"FileSize": 1000 + i, "MIMEType": "image/jpeg"},
+                    mime_type="image/jpeg",
+                    file_ts="2022-01-03 20:19:03",
+                    thumbnail="IMG_%06d.jpg.png" % i,
+                    tags=[],
+                    file_size=1000 + i)
+        store.reindex_search(None)
+        store.reconcile_stats()
+
+# -----------------------------------------------
+# Benchmarks
+
+def bench_store_pool(args):
+    """Cost of one thumbnail-style lookup with a fresh Store vs StorePool"""
+    with scratch_dir() as tmpdir, quiet():
+        dbfile = os.path.join(tmpdir, "bench.sqlite3")
+        fill_store(Store(dbfile), args.rows)
+        fname = "IMG_%06d.jpg" % (args.rows // 2)
+
+        def fresh_store():
+            store = Store(dbfile)
+            store.get_db_data_fname(fname)
+            store.close()
+
+        pool = StorePool(dbfile)
+        def pooled_store():
+            with pool.reader() as store:
+                store.get_db_data_fname(fname)
+
+        baseline = timed(fresh_store, args.requests)
+        pooled = timed(pooled_store, args.requests)
+        pool.close()
+
+    report("Store() per request", baseline)
+    report("StorePool.reader()", pooled, baseline)
+
+def sample_files(paths, limit):
+    """Files in paths (files or directories), at most limit"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            with os.scandir(path) as entries:
+                files.extend(sorted(e.path for e in entries if e.is_file()))
+        else:
+            files.append(path)
+    return files[:limit]
+
+def bench_exif(args):
+    """exiftool per file vs persistent exiftool -stay_open processes"""
+    files = sample_files(args.paths or [Config.upload_dir], args.limit)
+    if not files:
+        print("No sample files found")
+        return
+
+    exif_api = ExifApi(processes=1)
+    with quiet():
+        oneshot = timed(lambda: [exif_api.get_info_oneshot(f) for f in files], 1)
+
+        proc = ExifToolProcess()
+        proc.get_infos(files[:1]) # exclude startup time
+        per_file = timed(lambda: [proc.get_infos([f]) for f in files], 1)
+        batched = timed(lambda: [proc.get_infos(files[i:i + args.batch])
+                                 for i in range(0, len(files), args.batch)], 1)
+        proc.close()
+
+    print("%d files" % len(files))
+    report("exiftool per file", oneshot / len(files))
+    report("-stay_open, 1 file per call", per_file / len(files), oneshot)
+    report("-stay_open, %d files per call" % args.batch, batched / len(files), oneshot)
+
+def hash_sha256_block_size(path):
+    """HashLib.hash_sha256 before it used large reads"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while True:
+            chunk = file.read(h.block_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def bench_hash(args):
+    """sha256 throughput of HashLib on a large file"""
+    with scratch_dir() as tmpdir:
+        path = args.path
+        if not path:
+            path = os.path.join(tmpdir, "video.bin")
+            with open(path, "wb") as file:
+                for _ in range(args.size_mb):
+                    file.write(os.urandom(1 << 20))
+        size_mb = os.path.getsize(path) / (1 << 20)
+
+        print("%.0f MB file" % size_mb)
+        results = []
+        for name, fn in [("64 byte reads (old)", hash_sha256_block_size),
+                         ("1 MiB readinto", hash_sha256),
+                         ("mmap", hash_sha256_mmap)]:
+            per_call = timed(lambda: fn(path), 1)
+            results.append(fn(path))
+            print("%-32s %10.1f MB/s" % (name, size_mb / per_call))
+        assert len(set(results)) == 1
+
+# -----------------------------------------------
+# Synthetic library
+
+CAMERAS = [("Apple", "iPhone 12"), ("Apple", "iPhone 8"), ("Google", "Pixel 6"),
+           ("samsung", "SM-G991B"), ("Canon", "Canon EOS 80D"),
+           ("SONY", "ILCE-7M3"), ("NIKON CORPORATION", "NIKON D750")]
+
+# (mime_type, extension, weight)
+MIME_TYPES = [("image/jpeg", ".jpg", 70), ("image/heic", ".heic", 10),
+              ("image/png", ".png", 8), ("video/mp4", ".mp4", 10),
+              ("video/quicktime", ".mov", 2)]
+
+TAG_WORDS = ["beach", "birthday", "hike", "family", "snow", "city", "dogs",
+             "cats", "sunset", "wedding", "concert", "garden", "food", "roadtrip",
+             "school", "park", "museum", "party", "holiday", "friends", "camping",
+             "lake", "mountains", "baby", "grandma", "soccer", "christmas",
+             "halloween", "flowers", "work"]
+
+def tag_vocabulary(count):
+    """count distinct tag names, single words first"""
+    tags = list(TAG_WORDS)
+    for first in TAG_WORDS:
+        for second in TAG_WORDS:
+            if first != second:
+                tags.append(first + "-" + second)
+    for year in itertools.count(2000):
+        if len(tags) >= count:
+            break
+        tags.extend("%s-%d" % (word, year) for word in TAG_WORDS)
+    return tags[:count]
+
+# Most of real exiftool output is maker notes and other values nobody reads
+FILLER = ["%08x%08x" % (i * 2654435761 % (1 << 32), i) for i in range(4096)]
+
+def synthetic_exif(rng, fname, mime_type, file_ts, file_size, exif_bytes):
+    """exiftool -n -json style data of about exif_bytes bytes"""
+    make, model = rng.choice(CAMERAS)
+    exif_ts = file_ts.strftime("%Y:%m:%d %H:%M:%S")
+    exif = {
+            "SourceFile": Config.upload_path(fname),
+            "FileName": fname,
+            "FileSize": file_size,
+            "FileModifyDate": exif_ts + "+00:00",
+            "MIMEType": mime_type,
+            "Make": make,
+            "Model": model,
+            "DateTimeOriginal": exif_ts,
+            "CreateDate": exif_ts,
+            "ImageWidth": 4032,
+            "ImageHeight": 3024,
+            "GPSLatitude": round(rng.uniform(-60, 70), 6),
+            "GPSLongitude": round(rng.uniform(-180, 180), 6),
+        }
+    if mime_type.startswith("video/"):
+        exif.update(Duration=round(rng.uniform(1, 300), 3),
+                    TrackCreateDate=exif_ts,
+                    VideoFrameRate=30)
+    else:
+        exif.update(ExposureTime=rng.choice([1 / 60, 1 / 125, 1 / 500]),
+                    FNumber=rng.choice([1.8, 2.8, 4, 8]),
+                    ISO=rng.choice([50, 100, 400, 1600]),
+                    FocalLength=rng.choice([4.2, 26, 50]))
+
+    # About 30 bytes per filler entry
+    size = max(0, int(rng.gauss(exif_bytes, exif_bytes / 4)))
+    start = rng.randrange(len(FILLER))
+    for idx in range(size // 30):
+        exif["MakerNote%04d" % idx] = FILLER[(start + idx) % len(FILLER)]
+    return exif
+
+def generate_library(rows, seed=0, tags=500, exif_bytes=3000, thumbnails=1000,
+                     deleted_fraction=0.02):
+    """
+    Writes a synthetic Metadata database, and thumbnails for the first
+    thumbnails files, under the Config.py paths of the working directory.
+    See library_dir()
+
+    Files are taken in bursts ("events") spread over 20 years. About 60% are
+    untagged, the others have 1 to 4 tags drawn from a Zipf-like
+    distribution over tags names.
+    """
+    rng = random.Random(seed)
+    vocabulary = tag_vocabulary(tags)
+    cum_weights = list(itertools.accumulate(1 / rank
+                                            for rank in range(1, len(vocabulary) + 1)))
+    mime_cum_weights = list(itertools.accumulate(w for _, _, w in MIME_TYPES))
+    start = datetime.datetime(2005, 1, 1)
+    span = 20 * 365 * 86400
+
+    store = Store()
+    written = 0
+    pending_thumbnails = []
+    with store.batch():
+        file_ts = start
+        event_left = 0
+        for i in range(rows):
+            if not event_left:
+                event_left = rng.randint(1, 40)
+                file_ts = start + datetime.timedelta(seconds=rng.randrange(span))
+            event_left -= 1
+            file_ts += datetime.timedelta(seconds=rng.randint(1, 600))
+
+            mime_type, ext, _ = rng.choices(MIME_TYPES, cum_weights=mime_cum_weights)[0]
+            fname = "IMG_%07d%s" % (i, ext)
+            file_size = int(rng.lognormvariate(14.5, 0.8))
+            if mime_type.startswith("video/"):
+                file_size *= 20
+            file_tags = []
+            if rng.random() > 0.6:
+                file_tags = sorted(set(rng.choices(vocabulary, cum_weights=cum_weights,
+                                                   k=rng.randint(1, 4))))
+            deleted = rng.random() < deleted_fraction
+            thumbnail = fname + ".png"
+
+            store.metadata.insert(
+                    fname=fname,
+                    hash_sha256="%064x" % rng.getrandbits(256),
+                    time_db_added=file_ts,
+                    time_db_updated=file_ts,
+                    deleted=deleted,
+                    desc="",
+                    exif=synthetic_exif(rng, fname, mime_type, file_ts, file_size,
+                                        exif_bytes),
+                    mime_type=mime_type,
+                    file_ts=file_ts,
+                    thumbnail=thumbnail,
+                    tags=file_tags,
+                    file_size=file_size)
+
+            if not deleted and written < thumbnails:
+                pending_thumbnails.append((thumbnail, rng.randbytes(rng.randint(4, 12) << 10)))
+                written += 1
+
+        fill_tag_tables(store.cursor)
+        store.reindex_search(None)
+        store.reconcile_stats()
+
+    if Thumbnail.packed():
+        Thumbnail.pack_store().write(pending_thumbnails)
+    else:
+        for name, data in pending_thumbnails:
+            with open(Config.thumbnail_path(name), "wb") as file:
+                file.write(data)
+    store.close()
+
+def bench_generate(args):
+    """Writes a synthetic library to reuse with read-path --library"""
+    if os.path.exists(os.path.join(args.directory, Config.metadata_file)):
+        print(args.directory, "already has a database")
+        return
+    start = time.perf_counter()
+    with library_dir(args.directory), quiet():
+        generate_library(args.rows, seed=args.seed, tags=args.tags,
+                         exif_bytes=args.exif_bytes, thumbnails=args.thumbnails)
+    print("Generated %d rows in %.1fs" % (args.rows, time.perf_counter() - start))
+
+# -----------------------------------------------
+# Read path
+
+TILE_FIELDS = "fname,file_ts,thumbnail,tags,file_size,hash_sha256"
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def reset_peak_rss():
+    """Resets VmHWM (Linux). Returns False if that isn't possible"""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    """Peak RSS since reset_peak_rss(), or since the start without it"""
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def read_path_workloads(store, rng):
+    """
+    {name: generator}. Each generator yields request URLs and is sent the
+    response to the previous one
+    """
+    search_tags = [row.tag for row in store.get_tag_counts() if len(row.tag) >= 3]
+    months = [str(row.file_ts)[:7] for row in
+              store.metadata.get(["file_ts"], where={"deleted": False},
+                                 clause=("rowid % 97 = 0", []))]
+    if Thumbnail.packed():
+        names = Thumbnail.pack_store().names()
+    else:
+        names = os.listdir(Config.thumbnail_dir)
+    thumbnails = store.metadata.get(["thumbnail", "hash_sha256"],
+                                    clause=("thumbnail in (select value from json_each(?))",
+                                            [json.dumps(names)]))
+
+    def first_page():
+        while True:
+            yield "/db?count=50&fields=" + TILE_FIELDS
+
+    def walk():
+        cursor = ""
+        while True:
+            response = yield "/db?count=50&fields=%s&cursor=%s" % (TILE_FIELDS,
+                                                                   quote(cursor))
+            cursor = response.get_json()[2] or ""
+
+    def search(terms):
+        def urls():
+            while True:
+                yield "/db?count=50&fields=%s&search=%s" % (TILE_FIELDS,
+                                                            quote(rng.choice(terms)))
+        return urls
+
+    def repeat(url):
+        def urls():
+            while True:
+                yield url
+        return urls
+
+    def thumbnail():
+        while True:
+            row = rng.choice(thumbnails)
+            yield "/thumbnails/%s?v=%s" % (quote(row.thumbnail), row.hash_sha256)
+
+    workloads = {
+            "/db first page": first_page,
+            "/db page walk": walk,
+            "/db search tag": search(search_tags),
+            "/db search month": search(months),
+            "/tags": repeat("/tags?counts=1"),
+            "/db-stats": repeat("/db-stats"),
+            "/thumbnails": thumbnail,
+        }
+    if not search_tags:
+        del workloads["/db search tag"]
+    if not thumbnails:
+        del workloads["/thumbnails"]
+    return workloads
+
+def run_workload(client, urls, url, requests):
+    """
+    Requests url, then the URLs urls yields. Returns (sorted latencies in
+    seconds, total seconds, next url)
+    """
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(requests):
+        request_start = time.perf_counter()
+        response = client.get(url)
+        latencies.append(time.perf_counter() - request_start)
+        assert response.status_code == 200, (url, response.status_code)
+        url = urls.send(response)
+    return sorted(latencies), time.perf_counter() - start, url
+
+def compare(results, baseline_file):
+    with open(baseline_file) as file:
+        baseline = json.load(file)
+    print()
+    print("Compared to", baseline.get("commit") or baseline_file)
+    for name, result in results["endpoints"].items():
+        old = baseline["endpoints"].get(name)
+        if not old:
+            continue
+        print("%-20s p50 %6.2fx   p99 %6.2fx" % (name, result["p50_ms"] / old["p50_ms"],
+                                                  result["p99_ms"] / old["p99_ms"]))
+
+def bench_read_path(args):
+    """Latency, throughput and peak RSS of the read-only routes"""
+    with scratch_dir() as tmpdir:
+        path = args.library or tmpdir
+        with library_dir(path):
+            if not os.path.exists(Config.metadata_file):
+                start = time.perf_counter()
+                with quiet():
+                    generate_library(args.rows, seed=args.seed)
+                print("Generated %d rows in %.1fs" % (args.rows,
+                                                      time.perf_counter() - start))
+
+            with quiet():
+                import main
+                if args.no_cache:
+                    main.metadata_cache.max_entries = 0
+                client = main.app.test_client()
+                with main.store_pool.reader() as store:
+                    rows = store.metadata.count()
+                    workloads = read_path_workloads(store, random.Random(args.seed))
+
+            results = {
+                    "commit": (check_output(["git", "-C", os.path.dirname(os.path.abspath(__file__)),
+                                             "rev-parse", "--short", "HEAD"]) or "").strip(),
+                    "rows": rows,
+                    "requests": args.requests,
+                    "cache": not args.no_cache,
+                    "python": platform.python_version(),
+                    "sqlite": sqlite3.sqlite_version,
+                    "endpoints": {},
+                }
+            print("%d rows, %d requests per endpoint%s" %
+                  (rows, args.requests, ", no cache" if args.no_cache else ""))
+            print("%-20s %9s %9s %9s %10s" % ("", "p50 ms", "p99 ms", "req/s", "peak MB"))
+            for name, workload in workloads.items():
+                with quiet():
+                    urls = workload()
+                    _, _, url = run_workload(client, urls, next(urls), args.warmup)
+                    reset_peak_rss()
+                    latencies, total, _ = run_workload(client, urls, url, args.requests)
+                result = {
+                        "p50_ms": percentile(latencies, 0.5) * 1e3,
+                        "p99_ms": percentile(latencies, 0.99) * 1e3,
+                        "mean_ms": total / len(latencies) * 1e3,
+                        "throughput_rps": len(latencies) / total,
+                        "peak_rss_mb": peak_rss_mb(),
+                    }
+                results["endpoints"][name] = result
+                print("%-20s %9.2f %9.2f %9.0f %10.1f" %
+                      (name, result["p50_ms"], result["p99_ms"],
+                       result["throughput_rps"], result["peak_rss_mb"]))
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        compare(results, args.baseline)
+
+# -----------------------------------------------
+# Ingest
+
+# Seconds each fake tool sleeps per call. exiftool-startup is paid once per
+# exiftool process, exiftool per file
+TOOL_LATENCY = {
+        "exiftool-startup": 0.15,
+        "exiftool": 0.005,
+        "file": 0.002,
+        "convert": 0.05,
+        "ffmpeg": 0.1,
+        "ffprobe": 0.03,
+        "du": 0.01,
+    }
+
+FAKE_TOOL_HEADER = """\
+#!{python} -S
+import json, mimetypes, os, shutil, sys, time
+LATENCY = {latency!r}
+FRAME = {frame!r}
+"""
+
+# Deterministic stand-ins: output only depends on the arguments and on the
+# files' size and mtime
+FAKE_TOOLS = {
+        "exiftool": """
+def info(path):
+    stat = os.stat(path)
+    ts = time.strftime("%Y:%m:%d %H:%M:%S", time.gmtime(stat.st_mtime))
+    return {"SourceFile": path, "FileName": os.path.basename(path),
+            "FileSize": stat.st_size, "FileModifyDate": ts + "+00:00",
+            "DateTimeOriginal": ts,
+            "MIMEType": mimetypes.guess_type(path)[0] or "application/octet-stream"}
+
+def run(args):
+    infos = []
+    for path in args:
+        if not path.startswith("-") and os.path.isfile(path):
+            time.sleep(LATENCY["exiftool"])
+            infos.append(info(path))
+    return infos
+
+time.sleep(LATENCY["exiftool-startup"])
+if "-stay_open" in sys.argv:
+    args = []
+    for line in sys.stdin:
+        line = line.rstrip("\\n")
+        if line.startswith("-execute"):
+            infos = run(args)
+            args = []
+            if infos:
+                sys.stdout.write(json.dumps(infos) + "\\n")
+            sys.stdout.write("{ready%s}\\n" % line[len("-execute"):])
+            sys.stdout.flush()
+        elif line == "False" and args == ["-stay_open"]:
+            break
+        else:
+            args.append(line)
+    sys.exit(0)
+infos = run(sys.argv[1:])
+if not infos:
+    sys.exit(1)
+print(json.dumps(infos))
+""",
+        "file": """
+time.sleep(LATENCY["file"])
+print(mimetypes.guess_type(sys.argv[-1])[0] or "application/octet-stream")
+""",
+        "convert": """
+time.sleep(LATENCY["convert"])
+shutil.copyfile(FRAME, sys.argv[-1])
+""",
+        "ffmpeg": """
+time.sleep(LATENCY["ffmpeg"])
+shutil.copyfile(FRAME, sys.argv[-1])
+""",
+        "ffprobe": """
+time.sleep(LATENCY["ffprobe"])
+print("10.508333")
+""",
+        "du": """
+time.sleep(LATENCY["du"])
+print("1.0G\\t" + sys.argv[-1])
+""",
+    }
+
+def png_bytes(width, height, pixel):
+    """PNG image, pixel(x, y) returns (r, g, b)"""
+    raw = b"".join(b"\0" + bytes(itertools.chain.from_iterable(
+                pixel(x, y) for x in range(width)))
+                   for y in range(height))
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + \
+               struct.pack(">I", zlib.crc32(kind + data))
+    return b"\x89PNG\r\n\x1a\n" + \
+           chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + \
+           chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+def write_fake_tools(directory, latency):
+    """Writes the FAKE_TOOLS executables to directory"""
+    frame = os.path.join(directory, "frame.png")
+    with open(frame, "wb") as file:
+        file.write(png_bytes(320, 240, lambda x, y: (x % 256, y % 256, 128)))
+    header = FAKE_TOOL_HEADER.format(python=sys.executable, latency=latency,
+                                     frame=frame)
+    for name, body in FAKE_TOOLS.items():
+        path = os.path.join(directory, name)
+        with open(path, "w") as file:
+            file.write(header + body)
+        os.chmod(path, 0o755)
+
+def make_sample_files(directory, count, seed=0, video_fraction=0.1, video_kb=2048):
+    """
+    Writes count distinct files: JPEG photos (PNG without Pillow) and
+    videos of random bytes, which only the fake tools accept
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        if rng.random() < video_fraction:
+            path = os.path.join(directory, "VID_%05d.mp4" % i)
+            with open(path, "wb") as file:
+                file.write(rng.randbytes(video_kb << 10))
+        elif Thumbnail.available():
+            from PIL import Image, ImageDraw
+            path = os.path.join(directory, "IMG_%05d.jpg" % i)
+            img = Image.new("RGB", (1600, 1200), tuple(rng.randrange(256) for _ in range(3)))
+            draw = ImageDraw.Draw(img)
+            for _ in range(20):
+                x, y = rng.randrange(1500), rng.randrange(1100)
+                draw.rectangle((x, y, x + rng.randint(20, 800), y + rng.randint(20, 600)),
+                               fill=tuple(rng.randrange(256) for _ in range(3)))
+            img.save(path, "JPEG", quality=90)
+        else:
+            path = os.path.join(directory, "IMG_%05d.png" % i)
+            color = tuple(rng.randrange(256) for _ in range(3))
+            with open(path, "wb") as file:
+                file.write(png_bytes(400, 300, lambda x, y: color))
+        paths.append(path)
+    return paths
+
+def stage_times(before, after):
+    """
+    Per-stage totals from two metrics_totals() snapshots: {stage: seconds},
+    plus the number of commits
+    """
+    delta = {}
+    for key, (count, total) in after.items():
+        old_count, old_total = before.get(key, (0, 0))
+        delta[key] = (count - old_count, total - old_total)
+
+    def seconds(histogram, match=lambda labels: True):
+        return sum(total for (name, labels), (_, total) in delta.items()
+                   if name == histogram.name and match(labels))
+
+    mime = seconds(Metrics.tool_seconds, lambda labels: labels == ("file",))
+    return {
+            "exif": seconds(Metrics.tool_seconds,
+                            lambda labels: labels[0].startswith("exiftool")),
+            "hash": seconds(Metrics.hash_seconds),
+            "mime": mime,
+            # Store.thumbnail() runs file for the mime type
+            "thumbnail": seconds(Metrics.thumbnail_seconds) - mime,
+            "db write": seconds(Metrics.sql_seconds,
+                                lambda labels: not labels[0].startswith("select")),
+            "commits": delta.get((Metrics.sql_seconds.name, ("commit",)), (0, 0))[0],
+        }
+
+def metrics_totals():
+    """{(histogram name, labels): (count, sum)} of every histogram"""
+    result = {}
+    for histogram in Metrics.registry.values():
+        if isinstance(histogram, Metrics.Histogram):
+            for labels, totals in histogram.totals().items():
+                result[(histogram.name, labels)] = totals
+    return result
+
+def wait_for_ingest(pool, timeout=600):
+    """Waits until IngestQueue has no queued or running jobs"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with pool.reader() as store:
+            if not store.ingest_job.count(clause=("state in ('queued', 'running')", [])):
+                return
+        time.sleep(0.01)
+    raise TimeoutError("Ingest jobs didn't finish")
+
+def sample_data(sample, prefix):
+    """
+    Contents of sample made distinct per scenario, since /upload rejects
+    content it already has. Image and video decoders ignore trailing bytes
+    """
+    with open(sample, "rb") as file:
+        return file.read() + prefix.encode("utf8")
+
+def fake_tool_overhead(latency):
+    """Seconds a fake tool call takes on top of its configured latency"""
+    start = time.perf_counter()
+    for _ in range(3):
+        check_output(["du", "."])
+    return (time.perf_counter() - start) / 3 - latency["du"]
+
+def bench_ingest(args):
+    """Files/second, per stage time and commits of uploads and UpdateScript"""
+    latency = dict(TOOL_LATENCY)
+    for setting in args.tool_latency:
+        name, seconds = setting.split("=")
+        assert name in latency, "Unknown tool " + name
+        latency[name] = float(seconds)
+
+    with scratch_dir() as tmpdir:
+        if not args.real_tools:
+            bin_dir = os.path.join(tmpdir, "bin")
+            os.makedirs(bin_dir)
+            write_fake_tools(bin_dir, latency)
+            os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+            overhead = fake_tool_overhead(latency)
+
+        if args.samples:
+            samples = sample_files([args.samples], args.files)
+        else:
+            samples = make_sample_files(os.path.join(tmpdir, "samples"), args.files,
+                                        seed=args.seed)
+        sample_mb = sum(os.path.getsize(path) for path in samples) / (1 << 20)
+
+        with library_dir(os.path.join(tmpdir, "library")), quiet():
+            # /upload renders index.html, which Flask looks up in the
+            # working directory
+            os.symlink(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    "templates"), "templates")
+            import main
+            import UpdateScript
+            client = main.app.test_client()
+
+            def upload(batch_size, prefix):
+                for start in range(0, len(samples), batch_size):
+                    files = [(io.BytesIO(sample_data(sample, prefix)),
+                              prefix + os.path.basename(sample))
+                             for sample in samples[start:start + batch_size]]
+                    response = client.post("/upload", data={"files": files},
+                                           content_type="multipart/form-data")
+                    assert response.status_code == 200, response.status_code
+                wait_for_ingest(main.store_pool)
+
+            def scan(prefix, processes):
+                for sample in samples:
+                    path = Config.upload_path(prefix + os.path.basename(sample))
+                    with open(path, "wb") as file:
+                        file.write(sample_data(sample, prefix))
+                UpdateScript.scan(processes=processes)
+
+            scenarios = [
+                    ("upload, 1 file", lambda: upload(1, "u1-")),
+                    ("upload, %d files" % args.batch,
+                     lambda: upload(args.batch, "un-")),
+                    ("scan", lambda: scan("s-", None)),
+                    ("scan, 1 process", lambda: scan("s1-", 0)),
+                    ("update-thumbnails", lambda: UpdateScript.update_thumbnails(
+                            ["s1-" + os.path.basename(path) for path in samples])),
+                ]
+
+            results = {}
+            for name, fn in scenarios:
+                before = metrics_totals()
+                start = time.perf_counter()
+                fn()
+                elapsed = time.perf_counter() - start
+                results[name] = dict(stage_times(before, metrics_totals()),
+                                     files_per_second=len(samples) / elapsed)
+
+    print("%d files, %.1f MB, %s" % (len(samples), sample_mb,
+                                     "real tools" if args.real_tools else "fake tools"))
+    if not args.real_tools:
+        print("Fake tools take %.0f ms per call on top of --tool-latency "
+              "(interpreter startup)" % (overhead * 1e3))
+    print("Stage columns are seconds summed over all threads. scan runs them")
+    print("in worker processes, which aren't measured")
+    stages = ["exif", "hash", "mime", "thumbnail", "db write"]
+    print("%-20s %8s" % ("", "files/s") + "".join("%10s" % s for s in stages) +
+          "%9s" % "commits")
+    for name, result in results.items():
+        print("%-20s %8.1f" % (name, result["files_per_second"]) +
+              "".join("%10.2f" % result[s] for s in stages) +
+              "%9d" % result["commits"])
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"files": len(samples), "real_tools": args.real_tools,
+                       "tool_latency": None if args.real_tools else latency,
+                       "scenarios": results}, file, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    sub = subparsers.add_parser("store-pool", help=bench_store_pool.__doc__)
+    sub.add_argument("--rows", type=int, default=2000)
+    sub.add_argument("--requests", type=int, default=500)
+    sub.set_defaults(fn=bench_store_pool)
+
+    sub = subparsers.add_parser("exif", help=bench_exif.__doc__)
+    sub.add_argument("--limit", type=int, default=200)
+    sub.add_argument("--batch", type=int, default=50)
+    sub.add_argument("paths", nargs="*",
+                     help="Sample files or directories. Default: upload dir")
+    sub.set_defaults(fn=bench_exif)
+
+    sub = subparsers.add_parser("hash", help=bench_hash.__doc__)
+    sub.add_argument("--size-mb", type=int, default=512,
+                     help="Size of the generated file")
+    sub.add_argument("path", nargs="?",
+                     help="Hash this file instead of a generated one")
+    sub.set_defaults(fn=bench_hash)
+
+    sub = subparsers.add_parser("generate", help=bench_generate.__doc__)
+    sub.add_argument("--rows", type=int, default=100000)
+    sub.add_argument("--seed", type=int, default=0)
+    sub.add_argument("--tags", type=int, default=500,
+                     help="Number of distinct tags")
+    sub.add_argument("--exif-bytes", type=int, default=3000,
+                     help="Average size of the exif JSON")
+    sub.add_argument("--thumbnails", type=int, default=1000,
+                     help="Number of files with a (random bytes) thumbnail")
+    sub.add_argument("directory")
+    sub.set_defaults(fn=bench_generate)
+
+    sub = subparsers.add_parser("read-path", help=bench_read_path.__doc__)
+    sub.add_argument("--library", metavar="DIR",
+                     help="Library written by generate. Default: generate "
+                          "--rows rows in a temporary directory")
+    sub.add_argument("--rows", type=int, default=10000)
+    sub.add_argument("--seed", type=int, default=0)
+    sub.add_argument("--requests", type=int, default=500,
+                     help="Requests per endpoint")
+    sub.add_argument("--warmup", type=int, default=20)
+    sub.add_argument("--no-cache", action="store_true",
+                     help="Disable MetadataCache, every request hits sqlite")
+    sub.add_argument("--json", metavar="FILE", help="Write the results to FILE")
+    sub.add_argument("--baseline", metavar="FILE",
+                     help="Compare with the --json output of another run")
+    sub.set_defaults(fn=bench_read_path)
+
+    sub = subparsers.add_parser("ingest", help=bench_ingest.__doc__)
+    sub.add_argument("--files", type=int, default=100)
+    sub.add_argument("--seed", type=int, default=0)
+    sub.add_argument("--batch", type=int, default=20,
+                     help="Files per request for multi-file uploads")
+    sub.add_argument("--samples", metavar="DIR",
+                     help="Ingest copies of the files in DIR instead of "
+                          "generated ones")
+    sub.add_argument("--real-tools", action="store_true",
+                     help="Use exiftool, convert, ffmpeg... from PATH instead "
+                          "of the fakes")
+    sub.add_argument("--tool-latency", metavar="TOOL=SECONDS", action="append",
+                     default=[],
+                     help="Latency of a fake tool, one of: " + ", ".join(TOOL_LATENCY))
+    sub.add_argument("--json", metavar="FILE", help="Write the results to FILE")
+    sub.set_defaults(fn=bench_ingest)
+
+    args = parser.parse_args()
+    args.fn(args)
@@ -4,6 +4,58 @@ root_dir = "./data"
 metadata_file = os.path.join(root_dir, "00_metadata.sqlite3")
 upload_dir = os.path.join(root_dir, "uploads")
 thumbnail_dir = os.path.join(root_dir, "thumbnails")
+thumbnail_pack_dir = os.path.join(root_dir, "thumbnail_packs")
+
+# Threads running exiftool/thumbnailing for uploads. See IngestQueue
+ingest_workers = 2
+
+# Persistent exiftool processes. See Metadata.ExifApi
+exiftool_processes = ingest_workers
+
+# Number of query results kept by MetadataCache
+metadata_cache_size = 1024
+# Approximate memory used by MetadataCache, in bytes
+metadata_cache_bytes = 64 * 1024 * 1024
+
+# Seconds between recomputing the /db-stats totals from scratch. See
+# Metadata.Stats
+stats_reconcile_interval = 3600
+
+# Where thumbnails are kept:
+#   "files"  one file per thumbnail in thumbnail_dir
+#   "pack"   appended to pack files in thumbnail_pack_dir, see
+#            ThumbnailStore.py. Existing thumbnails are moved there with
+#            UpdateScript.py --import-thumbnails
+thumbnail_store = "files"
+
+# A new pack file is started once the last one reaches this size
+thumbnail_pack_size = 1 << 30
+
+# Thumbnail sizes in pixels. The smallest is used for the gallery tiles.
+# See Thumbnail.py
+thumbnail_sizes = (240, 480, 1200)
+
+# Hamming distance (out of 64 bits) between perceptual hashes of images
+# considered near-duplicates. See Similar.py
+similar_max_distance = 8
+
+# How /get sends uploaded files:
+#   None                Flask streams the file, with Range support
+#   "x-sendfile"        X-Sendfile header with the file's path (Apache
+#                       mod_xsendfile, lighttpd)
+#   "x-accel-redirect"  X-Accel-Redirect to sendfile_location + fname, an
+#                       internal nginx location serving upload_dir
+# Flask still checks that the file is known before handing it off.
+sendfile = None
+sendfile_location = "/internal/uploads/"
+
+# Logging, see Utils.trace. A background thread writes the records to
+# stdout and to log_file, which is rotated at log_max_bytes
+log_level = "INFO" # DEBUG adds commits and exiftool commands
+log_sql = False # every SQL statement, at DEBUG level
+log_file = "trace.log"
+log_max_bytes = 10 << 20
+log_backups = 5
 
 def upload_path(fname):
     return os.path.join(upload_dir, fname)
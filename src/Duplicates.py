@@ -0,0 +1,140 @@
+"""
+Finds uploaded files with the same content.
+
+Candidates are narrowed down in steps, each more expensive than the previous
+one and only run on the files left over by it:
+
+1. file_size from the database
+2. sha256 of the first and last 64 KiB of the file
+3. sha256 of the whole file. Metadata.hash_sha256 is used unless the file
+   changed since it was hashed
+4. Optionally, a byte by byte comparison
+
+See UpdateScript.py --duplicate-check
+"""
+from collections import defaultdict
+import filecmp
+import hashlib
+import os
+
+import Config
+from HashLib import hash_sha256
+
+PARTIAL_HASH_SIZE = 64 << 10
+
+# Columns find_duplicates() needs
+columns = ["fname", "file_size", "file_mtime_ns", "hash_sha256",
+           "time_db_added", "thumbnail"]
+
+def partial_hash(path, size):
+    """sha256 of the first and last PARTIAL_HASH_SIZE bytes of path"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as file:
+        if size <= 2 * PARTIAL_HASH_SIZE:
+            h.update(file.read())
+        else:
+            h.update(file.read(PARTIAL_HASH_SIZE))
+            file.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+            h.update(file.read(PARTIAL_HASH_SIZE))
+    return h.hexdigest()
+
+def full_hash(row, path):
+    """Metadata.hash_sha256 of row if it is still current, else hashes path"""
+    stat = os.stat(path)
+    if row.hash_sha256 and row.file_size == stat.st_size and \
+            row.file_mtime_ns == stat.st_mtime_ns:
+        return row.hash_sha256
+    return hash_sha256(path)
+
+def split(groups, key):
+    """
+    Splits every group by key(row). Rows for which key returns None (e.g.
+    the file disappeared) are dropped. Returns groups of 2 or more rows
+    """
+    result = []
+    for group in groups:
+        by_key = defaultdict(list)
+        for row in group:
+            value = key(row)
+            if value is not None:
+                by_key[value].append(row)
+        result.extend(rows for rows in by_key.values() if len(rows) > 1)
+    return result
+
+def same_bytes(groups):
+    """Splits groups by comparing file contents"""
+    result = []
+    for group in groups:
+        subgroups = []
+        for row in group:
+            path = Config.upload_path(row.fname)
+            for subgroup in subgroups:
+                if filecmp.cmp(Config.upload_path(subgroup[0].fname), path,
+                               shallow=False):
+                    subgroup.append(row)
+                    break
+            else:
+                subgroups.append([row])
+        result.extend(rows for rows in subgroups if len(rows) > 1)
+    return result
+
+def find_duplicates(rows, verify=False):
+    """
+    Arguments
+    ---------
+    rows : list(MetadataRow)
+        Rows with at least the columns listed in Duplicates.columns
+    verify : bool
+        Compare the files byte by byte after hashing
+
+    Returns a list of groups. Each group is a list of rows for files with
+    identical content
+    """
+    def on_disk(fn):
+        def key(row):
+            try:
+                return fn(row, Config.upload_path(row.fname))
+            except OSError:
+                return None
+        return key
+
+    groups = split([rows], lambda row: row.file_size)
+    groups = split(groups, on_disk(lambda row, path: partial_hash(path, row.file_size)))
+    groups = split(groups, on_disk(full_hash))
+    if verify:
+        groups = same_bytes(groups)
+    return groups
+
+def oldest_first(row):
+    return (row.time_db_added is None, row.time_db_added, row.fname)
+
+# Picks the file to keep in a group of duplicates
+policies = {
+        "keep-oldest": lambda group: min(group, key=oldest_first),
+        "keep-newest": lambda group: max(group, key=oldest_first),
+    }
+
+def report(groups, policy=None):
+    """
+    JSON serializable summary of find_duplicates() output
+
+    policy : str
+        Key of policies. Marks the file to keep in every group
+    """
+    result = {
+            "groups": [],
+            "duplicate_files": 0,
+            "wasted_bytes": 0,
+        }
+    for group in groups:
+        group = sorted(group, key=oldest_first)
+        entry = {
+                "file_size": group[0].file_size,
+                "fnames": [row.fname for row in group],
+            }
+        if policy:
+            entry["keep"] = policies[policy](group).fname
+        result["groups"].append(entry)
+        result["duplicate_files"] += len(group) - 1
+        result["wasted_bytes"] += (len(group) - 1) * (group[0].file_size or 0)
+    return result
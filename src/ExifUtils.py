@@ -1,5 +1,12 @@
 import datetime
+import json
+import os
 import re
+import select
+import subprocess
+import time
+
+from Metrics import tool_seconds
 
 def parse_exif_timestamp(inp):
     """
@@ -29,3 +36,90 @@ def from_exif_timestamp(*inps):
         return dt.strftime("%Y-%m-%d %H:%M:%S")
     assert False, "Couldn't parse any of the dates: " + str(inps)
 
+class ExifToolError(Exception):
+    pass
+
+class ExifToolProcess():
+    """
+    A long lived `exiftool -stay_open True -@ -` process. Avoids starting a
+    new perl interpreter for every file.
+
+    Arguments are written to stdin one per line, followed by -executeN.
+    exiftool writes the output of the command followed by a {readyN} line.
+    """
+    def __init__(self, executable="exiftool", timeout=60):
+        """
+        timeout : float
+            Seconds to wait for a command before the process is considered
+            hung and killed
+        """
+        self.timeout = timeout
+        self.seq = 0
+        self.proc = subprocess.Popen([executable, "-stay_open", "True", "-@", "-"],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def execute(self, *args):
+        """Returns the output of the command as bytes"""
+        if any("\n" in arg for arg in args):
+            raise ExifToolError("Arguments can't contain newlines")
+        if not self.alive():
+            raise ExifToolError("exiftool exited with %s" % self.proc.returncode)
+
+        start = time.perf_counter()
+        self.seq += 1
+        sentinel = ("{ready%d}" % self.seq).encode("ascii")
+        cmd = "\n".join(list(args) + ["-execute%d" % self.seq]) + "\n"
+        try:
+            self.proc.stdin.write(cmd.encode("utf8"))
+            self.proc.stdin.flush()
+        except OSError as exc:
+            raise ExifToolError("Failed to write to exiftool: %s" % exc)
+
+        fd = self.proc.stdout.fileno()
+        deadline = time.monotonic() + self.timeout
+        output = b""
+        while not output.rstrip().endswith(sentinel):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.kill()
+                raise ExifToolError("exiftool timed out")
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if not readable:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                self.kill()
+                raise ExifToolError("exiftool exited unexpectedly")
+            output += chunk
+
+        tool_seconds.observe(("exiftool -stay_open",), time.perf_counter() - start)
+        return output.rstrip()[:-len(sentinel)]
+
+    def get_infos(self, paths):
+        """
+        Returns {path: exiftool -n -json data} for the files exiftool could
+        read
+        """
+        output = self.execute("-n", "-json", *paths)
+        if not output.strip():
+            return {}
+        return {info["SourceFile"]: info for info in json.loads(output)}
+
+    def kill(self):
+        self.proc.kill()
+        self.proc.wait()
+
+    def close(self):
+        if not self.alive():
+            return
+        try:
+            self.proc.stdin.write(b"-stay_open\nFalse\n")
+            self.proc.stdin.flush()
+            self.proc.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
@@ -1,13 +1,59 @@
 import hashlib
+import mmap
+import time
+
+from Metrics import hash_seconds
+
+# hashlib releases the GIL while hashing buffers larger than 2 KiB, so large
+# reads also let other threads run
+BUF_SIZE = 1 << 20
 
 def hash_sha256(path):
+    start = time.perf_counter()
     h = hashlib.sha256()
+    buf = bytearray(BUF_SIZE)
+    view = memoryview(buf)
 
     with open(path, 'rb') as file:
         while True:
-            chunk = file.read(h.block_size)
+            size = file.readinto(buf)
+            if not size:
+                break
+            h.update(view[:size])
+
+    hash_seconds.observe(("hash_sha256",), time.perf_counter() - start)
+    return h.hexdigest()
+
+def hash_sha256_mmap(path):
+    """Same as hash_sha256. Hashes the whole file in one update() call"""
+    h = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        try:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return h.hexdigest()
+        with mapped:
+            h.update(mapped)
+
+    return h.hexdigest()
+
+def copy_and_hash(src, dstpath):
+    """
+    Writes the file object src to dstpath, hashing the data on the way.
+    Returns the sha256 hex digest of the data
+    """
+    start = time.perf_counter()
+    h = hashlib.sha256()
+
+    with open(dstpath, 'wb') as dst:
+        while True:
+            chunk = src.read(BUF_SIZE)
             if not chunk:
                 break
             h.update(chunk)
+            dst.write(chunk)
 
+    hash_seconds.observe(("copy_and_hash",), time.perf_counter() - start)
     return h.hexdigest()
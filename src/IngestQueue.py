@@ -0,0 +1,81 @@
+import queue
+import threading
+import traceback
+
+from Metadata import Store
+from Utils import trace
+
+class IngestQueue():
+    """
+    Runs Store.process for uploaded files in background threads so that
+    uploads don't wait for exiftool, hashing and thumbnailing.
+
+    Jobs are stored in the IngestJob table. Jobs that were queued or running
+    when the server stopped are retried by start().
+
+    The slow part (Store.prepare) runs without holding the writer. Only the
+    database update (Store.apply) goes through the StorePool writer.
+    """
+    max_attempts = 3
+
+    def __init__(self, pool, workers=2):
+        self.pool = pool
+        self.workers = workers
+        self.pending = queue.Queue()
+        self.threads = []
+
+    def start(self):
+        with self.pool.writer() as store:
+            job_ids = store.requeue_ingest_jobs(self.max_attempts)
+        if job_ids:
+            trace("IngestQueue: retrying", len(job_ids), "unfinished jobs")
+        for job_id in job_ids:
+            self.pending.put(job_id)
+
+        for idx in range(self.workers):
+            thread = threading.Thread(target=self.work,
+                                      name="ingest-%d" % idx,
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def enqueue(self, job_id):
+        """Hands a job added with Store.add_ingest_job to the workers"""
+        self.pending.put(job_id)
+
+    def depth(self):
+        """Number of jobs waiting for a worker"""
+        return self.pending.qsize()
+
+    def status(self, job_ids):
+        with self.pool.reader() as store:
+            return store.get_ingest_jobs(job_ids)
+
+    def work(self):
+        while True:
+            job_id = self.pending.get()
+            try:
+                self.run(job_id)
+            except Exception:
+                # Keep the worker alive. The job is retried on restart
+                trace("IngestQueue: job", job_id, "crashed", traceback.format_exc())
+
+    def run(self, job_id):
+        with self.pool.writer() as store:
+            job = store.claim_ingest_job(job_id)
+        if not job:
+            return
+
+        error = None
+        try:
+            with self.pool.reader() as store:
+                existing_data = store.get_db_data_fname(job.fname)
+            change = Store.prepare(job.path, existing_data, job.hash_sha256)
+            with self.pool.writer() as store:
+                store.apply(change)
+        except Exception as exc:
+            trace("IngestQueue: job", job_id, job.path, "failed:", exc)
+            error = str(exc) or exc.__class__.__name__
+
+        with self.pool.writer() as store:
+            store.finish_ingest_job(job_id, error)
@@ -1,14 +1,31 @@
+import atexit
+import base64
 from contextlib import contextmanager
 from collections import defaultdict
+import io
 import itertools
 import json
 import os
+import queue
 import sqlite3
 import subprocess
 import tempfile
+import threading
+import time
 
-from ExifUtils import from_exif_timestamp
+from ExifUtils import (
+        ExifToolError,
+        ExifToolProcess,
+        from_exif_timestamp,
+)
 from HashLib import hash_sha256
+from Metrics import (
+        observe_sql,
+        observe_tool,
+        thumbnail_seconds,
+)
+import Similar
+import Thumbnail
 from Utils import (
         ErrorResponse,
         OkayResponse,
@@ -17,28 +34,97 @@ from Utils import (
 import Config
 from Storage import (
         Bool,
+        Index,
         Int,
         Json,
         Table,
         Timestamp,
         Txt,
+        all_of,
+        migrate,
 )
 from Utils import (
         check_output,
+        debug,
         now,
         run,
         trace,
 )
 
 class ExifApi():
-    def get_info(self, path):
+    """
+    Runs exiftool through a small pool of persistent ExifToolProcess
+    instances. A process that fails or hangs is discarded and replaced on the
+    next call. If the persistent processes can't be used at all, falls back
+    to one exiftool per file.
+    """
+    def __init__(self, processes=2):
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(processes)
+        self.stay_open = True
+
+    @contextmanager
+    def process(self):
+        with self.slots:
+            try:
+                proc = self.idle.get_nowait()
+            except queue.Empty:
+                proc = ExifToolProcess()
+
+            try:
+                yield proc
+            except:
+                proc.kill()
+                raise
+            self.idle.put(proc)
+
+    def get_info_oneshot(self, path):
         cmd = ["exiftool", "-n", "-json", path]
-        trace(cmd)
+        debug(cmd)
+        start = time.perf_counter()
         output = subprocess.check_output(cmd)
+        observe_tool(cmd, start)
         jdata = json.loads(output)[0]
         return jdata
 
-exif_api = ExifApi()
+    def get_infos(self, paths):
+        """
+        Returns {path: exiftool -n -json data} for the paths exiftool could
+        read
+        """
+        if self.stay_open:
+            try:
+                with self.process() as proc:
+                    return proc.get_infos(paths)
+            except FileNotFoundError:
+                trace("exiftool not found")
+                raise
+            except (ExifToolError, OSError, ValueError) as exc:
+                trace("exiftool -stay_open failed, Error:", exc)
+
+        infos = {}
+        for path in paths:
+            try:
+                infos[path] = self.get_info_oneshot(path)
+            except Exception as exc:
+                trace("ExifApi failed for", path, "Error:", exc)
+        return infos
+
+    def get_info(self, path):
+        infos = self.get_infos([path])
+        if path not in infos:
+            raise ExifToolError("No exif data for " + path)
+        return infos[path]
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+exif_api = ExifApi(processes=Config.exiftool_processes)
+atexit.register(exif_api.close)
 
 class Metadata(Table):
     fields = [
@@ -48,33 +134,329 @@ class Metadata(Table):
             Timestamp("time_db_updated"),
             Bool("deleted"),
             Txt("desc"),
-            Json("exif"), # exiftool -json data
+            Json("exif", lazy=True), # exiftool -json data
             Txt("mime_type"),
             Timestamp("file_ts"), # timestamp for the file
             Txt("thumbnail"),
             Json("tags"),
+            Int("file_size"), # bytes, same as exif['FileSize']
+            Int("file_mtime_ns"), # os.stat() st_mtime_ns. See UpdateScript --scan
+            Txt("phash"), # perceptual hash of the thumbnail. See Similar.py
+        ]
+
+    indexes = [
+            Index("fname", unique=True),
+            Index("thumbnail"),
+            Index("file_ts"),
+            Index("deleted", "file_ts", "fname"), # /db pagination order
+            Index("hash_sha256"),
+        ]
+
+    def count_fnames(self, fnames_json):
+        """Number of rows with an fname in fnames_json, a JSON list"""
+        return self.count(clause=("fname in (select value from json_each(?))",
+                                  [fnames_json]))
+
+class MetadataSearchKey(Table):
+    """
+    Rowid of each fname in MetadataSearch. Metadata's own rowids can't be
+    used, VACUUM may renumber them
+    """
+    fields = [
+            Int("id", "primary key"),
+            Txt("fname"),
+        ]
+
+    indexes = [
+            Index("fname", unique=True),
+        ]
+
+class MetadataSearch(Table):
+    """
+    Trigram index over the text searched by Search.SubstrParam: file_ts and
+    tags, one per line. The rowid is MetadataSearchKey.id.
+    """
+    fields = [Txt("text")]
+
+    # file_ts and tags separated by newlines so that a match can't span
+    # two of them
+    text_sql = ("coalesce(file_ts, '') || char(10) || "
+                "coalesce((select group_concat(value, char(10)) from json_each(tags)), '')")
+
+    def create_cmd(self):
+        # pylint: disable=unused-variable,possibly-unused-variable
+        table = self.name
+        return ("create virtual table {table} using fts5(text, "
+                "tokenize='trigram case_sensitive 1');".format(**locals()),)
+
+    def add_missing_columns(self):
+        # Virtual tables can't be altered
+        pass
+
+    def exists(self):
+        """False if this sqlite was built without fts5 trigram support"""
+        return bool(self.fetchall("select count(*) from sqlite_master where name = ?;",
+                                  [self.name])[0][0])
+
+    def reindex(self, clause=None):
+        """
+        Refresh the index for Metadata rows matching clause, (sql, values).
+        All rows if clause is None
+        """
+        # pylint: disable=unused-variable,possibly-unused-variable
+        table = self.name
+        text_sql = self.text_sql
+        where, values = "", []
+        if clause:
+            where = "where " + clause[0]
+            values = list(clause[1])
+        self.execute("insert or ignore into MetadataSearchKey (fname) "
+                     "select fname from Metadata {where};".format(**locals()), values)
+        if clause:
+            self.execute("delete from {table} where rowid in "
+                         "(select id from MetadataSearchKey where fname in "
+                         "(select fname from Metadata {where}));".format(**locals()), values)
+        else:
+            self.execute("delete from {table};".format(**locals()))
+        self.execute("insert into {table} (rowid, text) "
+                     "select (select id from MetadataSearchKey where "
+                     "MetadataSearchKey.fname = Metadata.fname), {text_sql} "
+                     "from Metadata {where};".format(**locals()), values)
+
+class Tag(Table):
+    """
+    Every tag in use. file_count is the number of files (not deleted) that
+    have the tag
+    """
+    fields = [
+            Txt("tag"),
+            Int("file_count"),
+        ]
+
+    indexes = [
+            Index("tag", unique=True),
+        ]
+
+    def add(self, tags):
+        self.execute("insert or ignore into {} (tag, file_count) "
+                     "select value, 0 from json_each(?);".format(self.name),
+                     [json.dumps(sorted(tags))])
+
+    def refresh_counts(self, clause=None):
+        """
+        Recount files for tags matching clause, (sql, values). All tags if
+        clause is None
+        """
+        # pylint: disable=unused-variable,possibly-unused-variable
+        table = self.name
+        where, values = "", []
+        if clause:
+            where = "where " + clause[0]
+            values = list(clause[1])
+        self.execute("update {table} set file_count = "
+                     "(select count(*) from FileTag join Metadata using (fname) "
+                     "where FileTag.tag = {table}.tag and Metadata.deleted = 0) "
+                     "{where};".format(**locals()), values)
+
+class FileTag(Table):
+    """
+    (fname, tag) for every tag of every file. Metadata.tags holds the same
+    data as a JSON list
+    """
+    fields = [
+            Txt("fname"),
+            Txt("tag"),
+        ]
+
+    indexes = [
+            Index("fname", "tag", unique=True),
+            Index("tag"),
+        ]
+
+class IngestJob(Table):
+    """
+    Files waiting to be processed by Store.process. See IngestQueue
+    """
+    fields = [
+            Int("id", "primary key"),
+            Txt("path"),
+            Txt("fname"),
+            Txt("hash_sha256"), # computed while uploading, may be None
+            Txt("state"), # queued, running, done or failed
+            Int("attempts"),
+            Txt("error"),
+            Timestamp("time_created"),
+            Timestamp("time_updated"),
+        ]
+
+    indexes = [
+            Index("state"),
+            Index("fname"),
+            Index("hash_sha256"),
         ]
 
+class Stats(Table):
+    """
+    Number of files (not deleted) and their total size, overall (kind "all"),
+    per mime type and per month of file_ts. Kept up to date by Store._add,
+    _update and _delete. reconcile() recomputes it from Metadata
+    """
+    fields = [
+            Txt("kind"),
+            Txt("key"),
+            Int("file_count"),
+            Int("bytes"),
+        ]
+
+    indexes = [
+            Index("kind", "key", unique=True),
+        ]
+
+    # kind -> SQL expression for the key of a Metadata row
+    kinds = {
+            "all": "''",
+            "mime_type": "coalesce(mime_type, '')",
+            "month": "coalesce(substr(file_ts, 1, 7), '')",
+        }
+
+    def adjust(self, fname, sign):
+        """Adds (sign=1) or subtracts (sign=-1) the Metadata row of fname"""
+        # pylint: disable=unused-variable,possibly-unused-variable
+        table = self.name
+        for kind, key_sql in self.kinds.items():
+            self.execute("insert into {table} (kind, key, file_count, bytes) "
+                         "select ?, {key_sql}, ?, ? * coalesce(file_size, 0) "
+                         "from Metadata where fname = ? "
+                         "on conflict (kind, key) do update set "
+                         "file_count = file_count + excluded.file_count, "
+                         "bytes = bytes + excluded.bytes;".format(**locals()),
+                         [kind, sign, sign, fname])
+
+    def computed(self):
+        """Returns {(kind, key): (file_count, bytes)} computed from Metadata"""
+        result = {}
+        for kind, key_sql in self.kinds.items():
+            rows = self.fetchall("select {}, count(*), sum(coalesce(file_size, 0)) "
+                                 "from Metadata where deleted = 0 "
+                                 "group by 1;".format(key_sql))
+            for key, file_count, size in rows:
+                result[(kind, key)] = (file_count, size)
+        return result
+
+    def reconcile(self):
+        """
+        Replaces the stored totals with ones computed from Metadata if they
+        differ. Returns the number of (kind, key) entries that were wrong
+        """
+        expected = self.computed()
+        stored = {(row.kind, row.key): (row.file_count, row.bytes)
+                  for row in self.get(["kind", "key", "file_count", "bytes"],
+                                      clause=("file_count != 0 or bytes != 0", []))}
+        drift = sum(1 for key in expected.keys() | stored.keys()
+                    if expected.get(key) != stored.get(key))
+        if drift:
+            self.execute("delete from {};".format(self.name))
+            for (kind, key), (file_count, size) in expected.items():
+                self.insert(kind=kind, key=key, file_count=file_count, bytes=size)
+        return drift
+
+def drop_deleted_file_ts_index(cursor):
+    """Replaced by Metadata_deleted_file_ts_fname"""
+    cursor.execute("drop index if exists Metadata_deleted_file_ts;")
+
+def fill_file_size(cursor):
+    cursor.execute("update Metadata set file_size = json_extract(exif, '$.FileSize') "
+                   "where file_size is null and exif is not null;")
+
+def fill_search_index(cursor):
+    search_index = MetadataSearch(cursor, create=False)
+    if search_index.exists():
+        search_index.reindex()
+
+def fill_tag_tables(cursor):
+    file_tag = FileTag(cursor, create=False)
+    file_tag.execute("insert or ignore into FileTag (fname, tag) "
+                     "select Metadata.fname, json_each.value "
+                     "from Metadata, json_each(Metadata.tags);")
+    file_tag.execute("insert or ignore into Tag (tag, file_count) "
+                     "select distinct tag, 0 from FileTag;")
+    Tag(cursor, create=False).refresh_counts()
+
+def reconcile_stats(cursor):
+    Stats(cursor, create=False).reconcile()
+
+# Entry N upgrades the database from schema version N to N + 1. See
+# Storage.migrate
+migrations = [
+        None, # 1: Metadata indexes
+        drop_deleted_file_ts_index, # 2: keyset pagination index
+        fill_file_size, # 3: Metadata.file_size
+        fill_search_index, # 4: MetadataSearch
+        fill_tag_tables, # 5: Tag, FileTag
+        None, # 6: IngestJob
+        None, # 7: IngestJob.hash_sha256
+        None, # 8: Metadata.file_mtime_ns
+        None, # 9: IngestJob.hash_sha256 index
+        None, # 10: Metadata.phash
+        reconcile_stats, # 11: Stats
+        fill_search_index, # 12: MetadataSearchKey
+    ]
+
 class Store():
-    def __init__(self, fname=Config.metadata_file):
+    def __init__(self, fname=Config.metadata_file, init_schema=True,
+                 check_same_thread=True):
+        """
+        Arguments
+        ---------
+        init_schema : bool
+            Create or migrate the schema. Only needed once per process, see
+            StorePool
+        check_same_thread : bool
+            Passed to sqlite3. Must be False if the Store is handed between
+            threads (one thread at a time)
+        """
         self.fname = fname
-        self.conn = sqlite3.connect(self.fname)
+        self.conn = sqlite3.connect(self.fname,
+                                    check_same_thread=check_same_thread)
         self.cursor = self.conn.cursor()
-        self.metadata = Metadata(self.cursor)
+        self.metadata = Metadata(self.cursor, create=False)
+        self.search_key = MetadataSearchKey(self.cursor, create=False)
+        self.search_index = MetadataSearch(self.cursor, create=False)
+        self.tag = Tag(self.cursor, create=False)
+        self.file_tag = FileTag(self.cursor, create=False)
+        self.ingest_job = IngestJob(self.cursor, create=False)
+        self.stats = Stats(self.cursor, create=False)
 
         self.commit_ctx_depth = 0
-        self.commit()
+        if init_schema:
+            migrate(self.cursor,
+                    [self.metadata, self.search_key, self.search_index, self.tag,
+                     self.file_tag, self.ingest_job, self.stats],
+                    migrations)
+            self.commit()
+
+        self.search_indexed = self.search_index.exists()
+
+    def close(self):
+        self.cursor.close()
+        self.conn.close()
 
     @staticmethod
     def upload_dir_disk_usage():
         cmd = ["du", "-sh", Config.upload_dir.rstrip("/") + "/"]
+        start = time.perf_counter()
         output = subprocess.check_output(cmd)
+        observe_tool(cmd, start)
         # Sample output
         # 4.4G    uploads/
         return output.split()[0].decode("utf-8")
 
     @staticmethod
-    def samefile(path, fname, exif, existing_data):
+    def samefile(path, fname, exif, existing_data, sha256=None):
+        """
+        sha256 : str
+            Digest of path if already known
+        """
         if not existing_data and not exif:
             return True
         assert existing_data and exif
@@ -84,12 +466,14 @@ class Store():
 
         return metadata_exif['FileSize'] == exif['FileSize'] and \
                 metadata_exif['FileModifyDate'] == exif['FileModifyDate'] and \
-            existing_data[col_idxs['hash_sha256']] == hash_sha256(path)
+            existing_data[col_idxs['hash_sha256']] == (sha256 or hash_sha256(path))
 
     @staticmethod
     def mime_type(path):
         cmd = ["file", "-b", "--mime-type", path]
+        start = time.perf_counter()
         output = subprocess.check_output(cmd).decode("utf8")
+        observe_tool(cmd, start)
         return output
 
     @staticmethod
@@ -137,9 +521,47 @@ class Store():
         return dstpath
 
     @staticmethod
-    def thumbnail(path, fname, size=240):
-        """Returns thumbnail path"""
-        mime_type = Store.mime_type(path)
+    def remove_tmpfile(path):
+        if not path:
+            return
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def thumbnail(path, fname):
+        """Returns thumbnail name"""
+        start = time.perf_counter()
+        engine = "pillow" if Thumbnail.available() else "convert"
+        try:
+            mime_type = Store.mime_type(path)
+            if not Thumbnail.available():
+                return Thumbnail.store_file(
+                        Store.thumbnail_convert(path, fname, mime_type))
+
+            if "image" in mime_type:
+                # ImageMagick reads formats Pillow can't, e.g. HEIC
+                return Thumbnail.make(path, fname) or Thumbnail.store_file(
+                        Store.thumbnail_convert(path, fname, mime_type))
+
+            elif "video" in mime_type:
+                tmpframe = Store.video_frame(path)
+                if not tmpframe:
+                    return None
+                duration = Store.video_duration(path)
+                try:
+                    return Thumbnail.make(tmpframe, fname, text=duration)
+                finally:
+                    Store.remove_tmpfile(tmpframe)
+
+            return None
+        finally:
+            thumbnail_seconds.observe((engine,), time.perf_counter() - start)
+
+    @staticmethod
+    def thumbnail_convert(path, fname, mime_type, size=240):
+        """Single size thumbnail using ImageMagick. Returns thumbnail name"""
         thumbnail_path = os.path.join(Config.thumbnail_dir, fname)
         if not thumbnail_path.endswith(".png"):
             thumbnail_path += ".png"
@@ -155,6 +577,7 @@ class Store():
             tmpframe = Store.video_frame(path)
             duration = Store.video_duration(path)
             dstpath = Store.resize_image(tmpframe, thumbnail_path, size, text=duration)
+            Store.remove_tmpfile(tmpframe)
             if not dstpath:
                 return dstpath
             return os.path.split(dstpath)[-1]
@@ -180,7 +603,7 @@ class Store():
         """
         before_ctx_count = self.commit_ctx_depth
         self.commit_ctx_depth += 1
-        trace("commit_ctx_depth", self.commit_ctx_depth)
+        debug("commit_ctx_depth", self.commit_ctx_depth)
 
         yield
 
@@ -192,36 +615,71 @@ class Store():
 
     def commit(self):
         if self.commit_ctx_depth == 0:
-            trace("commit")
+            debug("commit")
+            start = time.perf_counter()
             self.conn.commit()
+            observe_sql("commit", start)
         else:
-            trace("skipping commit. commit_ctx_depth", self.commit_ctx_depth)
+            debug("skipping commit. commit_ctx_depth", self.commit_ctx_depth)
+
+    def rollback(self):
+        """Discard uncommitted changes and any open batch()"""
+        debug("rollback")
+        self.commit_ctx_depth = 0
+        self.conn.rollback()
 
     # -------------------------------------------
     # Modifying DB
 
-    def _add(self, path, fname, exif):
+    @staticmethod
+    def file_values(path, fname, exif, sha256=None):
+        """
+        Metadata values derived from the file. Slow: hashes the file (unless
+        sha256 is given) and generates the thumbnail
+        """
+        thumbnail = Store.thumbnail(path, fname)
+        return {
+                "hash_sha256": sha256 or hash_sha256(path),
+                "exif": exif,
+                "mime_type": exif['MIMEType'],
+                "file_ts": from_exif_timestamp(exif.get('DateTimeOriginal'),
+                                               exif.get('CreateDate'),
+                                               exif.get('TrackCreateDate'),
+                                               exif.get('SubSecCreateDate'),
+                                               exif.get('FileModifyDate')),
+                "thumbnail": thumbnail,
+                "phash": Store.phash(thumbnail),
+                "file_size": exif.get('FileSize'),
+                "file_mtime_ns": os.stat(path).st_mtime_ns,
+            }
+
+    @staticmethod
+    def phash(thumbnail):
+        """Perceptual hash of the thumbnail, None without one"""
+        data = Thumbnail.read(thumbnail) if thumbnail else None
+        if data is None:
+            return None
+        return Similar.dhash_file(io.BytesIO(data))
+
+    def _add(self, fname, values):
         trace(fname, "found new file")
         ts = now()
-        thumbnail_path = Store.thumbnail(path, fname)
         self.metadata.insert(
                 fname=fname,
-                hash_sha256=hash_sha256(path),
                 time_db_added=ts,
                 time_db_updated=ts,
                 deleted=False,
                 desc="",
-                exif=exif,
-                mime_type=exif['MIMEType'],
-                file_ts = from_exif_timestamp(exif.get('DateTimeOriginal'),
-                                              exif.get('CreateDate'),
-                                              exif.get('TrackCreateDate'),
-                                              exif.get('SubSecCreateDate'),
-                                              exif.get('FileModifyDate')),
-                thumbnail=thumbnail_path,
-                tags=[])
+                tags=[],
+                **values)
+        self.stats.adjust(fname, 1)
+        self.reindex_search(("fname = ?", [fname]))
         self.commit()
 
+    def reindex_search(self, clause):
+        if self.search_indexed:
+            self.search_index.reindex(clause)
+
     def _delete(self, path, fname, existing_data):
         assert existing_data
         deleted_idx = Metadata.column_idx("deleted")
@@ -230,33 +688,48 @@ class Store():
             return
 
         trace(fname, "deleted")
+        self.stats.adjust(fname, -1)
         self.metadata.update(
                 {"deleted": True},
                 {"fname": fname})
+        self.tag.refresh_counts(("tag in (select tag from FileTag where fname = ?)",
+                                 [fname]))
         self.commit()
 
-    def _update(self, path, fname, exif, existing_data):
+    def _update(self, fname, values, existing_data):
         trace(fname, "updating existing data")
-        ts = now()
-        thumbnail_path = Store.thumbnail(path, fname)
-        self.metadata.update(
-                {"hash_sha256": hash_sha256(path),
-                 "time_db_updated": ts,
-                 "deleted": False,
-                 "exif": exif,
-                 "mime_type": exif['MIMEType'],
-                 "file_ts": from_exif_timestamp(exif.get('DateTimeOriginal'),
-                                                exif.get('CreateDate'),
-                                                exif.get('TrackCreateDate'),
-                                                exif.get('SubSecCreateDate'),
-                                                exif.get('FileModifyDate')),
-                 "thumbnail_path": thumbnail_path,
-                 "tags": existing_data.tags,
-                },
-                {"fname": fname})
+        values = dict(values,
+                      time_db_updated=now(),
+                      deleted=False)
+        if not existing_data.deleted:
+            self.stats.adjust(fname, -1)
+        self.metadata.update(values, {"fname": fname})
+        self.stats.adjust(fname, 1)
+        self.reindex_search(("fname = ?", [fname]))
+        if existing_data.deleted:
+            self.tag.refresh_counts(("tag in (select tag from FileTag where fname = ?)",
+                                     [fname]))
         self.commit()
 
-    def process(self, path):
+    @staticmethod
+    def prepare(path, existing_data, sha256=None):
+        """
+        The slow part of process(). Runs exiftool and, for new or modified
+        files, hashing and thumbnailing. Doesn't use the database, so it can
+        run without holding the writer.
+
+        Arguments
+        ---------
+        existing_data : MetadataRow
+            Current row for the file, None if there is none
+        sha256 : str
+            Digest of path if already known, e.g. computed during upload
+
+        Returns (action, fname, values) to pass to apply(). action is one of
+        "add", "update", "delete", "stat" (only file_mtime_ns changed) or None
+        when there is nothing to do. Raises ExifToolError if exiftool can't
+        read a file that isn't in the database (or was deleted from it)
+        """
         fname = os.path.split(path)[1]
 
         exif = None
@@ -267,36 +740,144 @@ class Store():
             trace("ExifApi failed for", path, "Error:", exc)
             pass
 
-        ts = now()
-        existing_data = self.metadata.get('*',
-                                          where={"fname": fname})
-        existing_data = existing_data[0] if existing_data else None
-
         if not existing_data and exif:
-            self._add(path, fname, exif)
+            return ("add", fname, Store.file_values(path, fname, exif, sha256))
 
-        elif existing_data and not exif:
-            self._delete(path, fname, existing_data)
+        elif existing_data and not existing_data.deleted and not exif:
+            return ("delete", fname, None)
 
-        elif not exif or Store.samefile(path, fname, exif, existing_data):
-            # nothing to do
+        elif not exif:
+            # Otherwise an upload would be reported done but never show up
+            raise ExifToolError("exiftool couldn't read %s" % fname)
+
+        elif existing_data.deleted:
+            # The file is back, possibly unchanged
+            return ("update", fname, Store.file_values(path, fname, exif, sha256))
+
+        elif Store.samefile(path, fname, exif, existing_data, sha256):
+            # Remember the mtime of unchanged files so that the next scan can
+            # skip them without running exiftool
+            mtime_ns = os.stat(path).st_mtime_ns
+            if existing_data.file_mtime_ns != mtime_ns:
+                return ("stat", fname, {"file_mtime_ns": mtime_ns})
+            return (None, fname, None)
+
+        return ("update", fname, Store.file_values(path, fname, exif, sha256))
+
+    def apply(self, change):
+        """
+        Writes a change computed by prepare(). The row is looked up again
+        because it may have changed since prepare() ran
+        """
+        action, fname, values = change
+        if action is None:
             return
 
+        existing_data = self.get_db_data_fname(fname)
+        if action == "delete":
+            if existing_data:
+                self._delete(Config.upload_path(fname), fname, existing_data)
+        elif action == "stat":
+            if existing_data:
+                self.metadata.update(values, {"fname": fname})
+                self.commit()
+        elif existing_data:
+            self._update(fname, values, existing_data)
         else:
-            self._update(path, fname, exif, existing_data)
+            self._add(fname, values)
+
+    def process(self, path):
+        fname = os.path.split(path)[1]
+        existing_data = self.get_db_data_fname(fname)
+        self.apply(Store.prepare(path, existing_data))
 
     # -------------------------------------------
-    # Tag manipulation
+    # Ingest jobs
 
-    def update_tags(self, fnames, add_tags, remove_tags):
-        fnames = set(fnames)
-        add_tags = set(add_tags)
-        remove_tags = set(remove_tags)
+    def add_ingest_job(self, path, sha256=None):
+        """Returns the job id"""
+        ts = now()
+        cursor = self.ingest_job.insert(path=path,
+                                        fname=os.path.split(path)[1],
+                                        hash_sha256=sha256,
+                                        state="queued",
+                                        attempts=0,
+                                        time_created=ts,
+                                        time_updated=ts)
+        self.commit()
+        return cursor.lastrowid
 
-        # Input validation
-        if not fnames:
-            return ErrorResponse("No files specified")
+    def claim_ingest_job(self, job_id):
+        """Marks a queued job as running. Returns the job row, None if the
+        job isn't queued"""
+        jobs = self.ingest_job.get('*', where={"id": job_id, "state": "queued"})
+        if not jobs:
+            return None
+        self.ingest_job.update({"state": "running",
+                                "attempts": jobs[0].attempts + 1,
+                                "time_updated": now()},
+                               {"id": job_id})
+        self.commit()
+        return jobs[0]
+
+    def finish_ingest_job(self, job_id, error=None):
+        self.ingest_job.update({"state": "failed" if error else "done",
+                                "error": error,
+                                "time_updated": now()},
+                               {"id": job_id})
+        self.commit()
+
+    def requeue_ingest_jobs(self, max_attempts):
+        """
+        Jobs left queued or running when the server stopped are queued again,
+        unless they already failed max_attempts times. Returns queued job ids
+        """
+        with self.batch():
+            self.ingest_job.execute(
+                    "update IngestJob set state = 'failed', "
+                    "error = 'Too many attempts' "
+                    "where state = 'running' and attempts >= ?;", [max_attempts])
+            self.ingest_job.execute(
+                    "update IngestJob set state = 'queued' where state = 'running';")
+        jobs = self.ingest_job.get(["id"], where={"state": "queued"},
+                                   order_by=["id"])
+        return [job.id for job in jobs]
+
+    def get_ingest_jobs(self, job_ids):
+        return self.ingest_job.get(["id", "fname", "state", "error"],
+                                   clause=("id in (select value from json_each(?))",
+                                           [json.dumps(list(job_ids))]),
+                                   order_by=["id"])
+
+    def ingest_pending(self, fname):
+        """True if fname is queued or being processed"""
+        return bool(self.ingest_job.count(
+                where={"fname": fname},
+                clause=("state in ('queued', 'running')", [])))
+
+    def duplicate_of(self, sha256):
+        """
+        Returns the fname of a file, or of a queued upload, with content
+        sha256. None if there is none
+        """
+        rows = self.metadata.get(["fname"],
+                                 where={"hash_sha256": sha256, "deleted": False},
+                                 limit=1)
+        if not rows:
+            rows = self.ingest_job.get(["fname"],
+                                       where={"hash_sha256": sha256},
+                                       clause=("state in ('queued', 'running')", []),
+                                       limit=1)
+        if rows:
+            return rows[0].fname
+        return None
 
+    # -------------------------------------------
+    # Tag manipulation
+
+    @staticmethod
+    def validate_tag_edit(add_tags, remove_tags):
+        """Returns ErrorResponse for a bad edit, None otherwise"""
         if not add_tags and not remove_tags:
             return ErrorResponse("No modification of tags requested")
 
@@ -306,73 +887,244 @@ class Store():
             if len(tag) < 3:
                 return ErrorResponse("Tag too short", str(tag))
 
-        files_by_tags = self.get_files_by_tags(fnames=fnames)
-        if isinstance(files_by_tags, ErrorResponse):
-            return files_by_tags
+        return None
 
-        # TODO: Optimize this code to group writes
+    @staticmethod
+    def tag_edit_response(count, add_tags, remove_tags, dry_run):
+        verb = "would be modified" if dry_run else "modified"
+        msg = "%d files %s: added %d tags, removed %d tags" % (count, verb,
+                                                               len(add_tags),
+                                                               len(remove_tags))
+        return OkayResponse(msg, count)
+
+    def update_tags(self, fnames, add_tags, remove_tags, dry_run=False):
+        """
+        Returns ["OKAY", message, file count] or ErrorResponse
+        """
+        fnames = set(fnames)
+        add_tags = set(add_tags)
+        remove_tags = set(remove_tags)
+
+        # Input validation
+        if not fnames:
+            return ErrorResponse("No files specified")
+
+        error = Store.validate_tag_edit(add_tags, remove_tags)
+        if error:
+            return error
+
+        fnames_json = json.dumps(sorted(fnames))
+        if self.metadata.count_fnames(fnames_json) != len(fnames):
+            return ErrorResponse("Some files weren't found in store")
+
+        if not dry_run:
+            with self.batch():
+                self._update_tags(fnames_json, add_tags, remove_tags)
+
+        return Store.tag_edit_response(len(fnames), add_tags, remove_tags, dry_run)
+
+    def update_tags_by_search(self, search, add_tags, remove_tags, dry_run=False):
+        """
+        Applies a tag edit to every file (not deleted) matching search, a
+        Search.Search, in a single transaction
+
+        Returns ["OKAY", message, file count] or ErrorResponse
+        """
+        add_tags = set(add_tags)
+        remove_tags = set(remove_tags)
+
+        if search.error_response:
+            return search.error_response
+        if not search.filtering:
+            return ErrorResponse("No search specified")
+
+        error = Store.validate_tag_edit(add_tags, remove_tags)
+        if error:
+            return error
+
+        selection = all_of([("deleted = 0", []),
+                            search.clause(self.search_indexed)])
         with self.batch():
-            for tags, sub_fnames  in files_by_tags.items():
-                new_tags = sorted(set(tags) - remove_tags | add_tags)
-                for fname in sub_fnames:
-                    self.metadata.update({"tags": new_tags}, {"fname": fname})
+            # The search is evaluated once: the statements below change the
+            # tags and the search index it matches against
+            fnames = [row.fname for row in
+                      self.metadata.get(["fname"], clause=selection)]
+            if fnames and not dry_run:
+                self._update_tags(json.dumps(fnames), add_tags, remove_tags)
 
-        msg = "%d files: added %d tags, removed %d tags" % (len(fnames),
-                                                            len(add_tags),
-                                                            len(remove_tags))
-        return OkayResponse(msg)
+        return Store.tag_edit_response(len(fnames), add_tags, remove_tags, dry_run)
+
+    def _update_tags(self, fnames_json, add_tags, remove_tags):
+        """
+        Set based tag update of the files in fnames_json, a JSON list. Runs
+        the same handful of statements however many files are selected
+        """
+        selected = ("fname in (select value from json_each(?))", [fnames_json])
+        add_json = json.dumps(sorted(add_tags))
+        remove_json = json.dumps(sorted(remove_tags))
+
+        if add_tags:
+            self.tag.add(add_tags)
+            self.file_tag.execute(
+                    "insert or ignore into FileTag (fname, tag) "
+                    "select Metadata.fname, json_each.value from Metadata, json_each(?) "
+                    "where Metadata.%s;" % selected[0],
+                    [add_json] + selected[1])
+        if remove_tags:
+            self.file_tag.execute(
+                    "delete from FileTag where tag in (select value from json_each(?)) "
+                    "and %s;" % selected[0],
+                    [remove_json] + selected[1])
+
+        # Keep the JSON copy in Metadata.tags sorted, as before
+        self.metadata.execute(
+                "update Metadata set tags = "
+                "(select json_group_array(tag) from "
+                "(select tag from FileTag where FileTag.fname = Metadata.fname order by tag)) "
+                "where %s;" % selected[0], selected[1])
+        self.tag.refresh_counts(("tag in (select value from json_each(?))",
+                                 [json.dumps(sorted(add_tags | remove_tags))]))
+        self.reindex_search(selected)
 
     # -------------------------------------------
     # Fetching metadata
 
-    def get_db_data(self, deleted=None, reverse=False):
+    def get_db_data(self, deleted=None, reverse=False, cols='*'):
+        """
+        cols : list(str)
+            Columns to fetch. All columns by default
+        """
         where = {}
         if deleted is not None:
             where["deleted"] = deleted
-        data = self.metadata.get('*', where=where,
+        data = self.metadata.get(cols, where=where,
                                  order_by=["file_ts " +
                                            ("asc" if reverse else "desc")])
         return data
 
+    @staticmethod
+    def encode_page_cursor(row):
+        """Opaque cursor pointing just past row in get_db_page order"""
+        key = json.dumps([row.file_ts, row.fname]).encode("utf8")
+        return base64.urlsafe_b64encode(key).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def decode_page_cursor(cursor):
+        """Returns (file_ts, fname). Raises ValueError for a bad cursor"""
+        try:
+            padded = cursor + "=" * (-len(cursor) % 4)
+            file_ts, fname = json.loads(base64.urlsafe_b64decode(padded))
+        except Exception as exc:
+            raise ValueError("Bad cursor") from exc
+        if not isinstance(file_ts, str) or not isinstance(fname, str):
+            raise ValueError("Bad cursor")
+        return file_ts, fname
+
+    def get_db_page(self, cursor=None, count=50, deleted=False,
+                    reverse=False, cols='*', clause=None):
+        """
+        Keyset pagination over (file_ts, fname). Ordering, the deleted filter
+        and the limit are evaluated by sqlite so that every page costs the same.
+
+        Arguments
+        ---------
+        cursor : str
+            Value returned by a previous call. None for the first page
+        clause : (str, list)
+            Optional SQL condition, e.g. Search.clause()
+        cols : list(str)
+            Columns to fetch. Rows also carry the columns needed for the
+            cursor
+
+        Returns (rows, next_cursor). next_cursor is None after the last page.
+        """
+        order = "asc" if reverse else "desc"
+        op = ">" if reverse else "<"
+        key = Store.decode_page_cursor(cursor) if cursor else None
+        if cols != '*':
+            cols = list(cols) + [col for col in ["file_ts", "fname"] if col not in cols]
+
+        assert count > 0
+        conditions = [clause] if clause else []
+        if key:
+            conditions.append(("(file_ts, fname) %s (?, ?)" % op, list(key)))
+        rows = self.metadata.get(cols, where={"deleted": deleted},
+                                 clause=all_of(conditions),
+                                 order_by=["file_ts " + order, "fname " + order],
+                                 limit=count)
+        if len(rows) < count:
+            # Reached the end of the table
+            return rows, None
+        return rows, Store.encode_page_cursor(rows[-1])
+
     def get_db_data_fname(self, fname):
         data = self.metadata.get('*', {"fname": fname})
         if data:
             return data[0]
         return None
 
+    def get_stats(self):
+        """
+        Returns {kind: {key: (file_count, bytes)}}, see Stats. The totals
+        are under stats["all"][""]
+        """
+        stats = {kind: {} for kind in Stats.kinds}
+        stats["all"][""] = (0, 0)
+        for row in self.stats.get(["kind", "key", "file_count", "bytes"],
+                                  clause=("file_count > 0", [])):
+            stats[row.kind][row.key] = (row.file_count, row.bytes)
+        return stats
+
+    def reconcile_stats(self):
+        """Recomputes Stats. Returns the number of wrong entries found"""
+        drift = self.stats.reconcile()
+        if drift:
+            trace("Stats: corrected", drift, "entries")
+        self.commit()
+        return drift
+
+    def get_phashes(self):
+        """Returns [(fname, phash), ...] for files with a phash"""
+        return self.metadata.get(["fname", "phash"], where={"deleted": False},
+                                 clause=("phash is not null", []))
+
     def get_files_by_tags(self, fnames=None):
         """
         Arguments
         ---------
         fnames : set(str)
-            Only  return tags for filenames in fnames. Raises ErrorResponse when
+            Only  return tags for filenames in fnames. Returns ErrorResponse when
             fname is not found
+
+        Returns {tuple(sorted tags): [fname, ...]}
         """
-        # TODO: This should be optimized to filter by fnames
-        existing_data = self.metadata.get(['fname', 'tags'])
-        if fnames and not fnames.issubset(set(row.fname for row in existing_data)):
-            return ErrorResponse("Some files weren't found in store")
+        clause = None
+        if fnames:
+            fnames_json = json.dumps(sorted(fnames))
+            if self.metadata.count_fnames(fnames_json) != len(fnames):
+                return ErrorResponse("Some files weren't found in store")
+            clause = ("fname in (select value from json_each(?))", [fnames_json])
+        existing_data = self.metadata.get(['fname', 'tags'], clause=clause)
 
         # Group files by tag combination to reduce number of writes
         files_by_tags = defaultdict(list)
         for row in existing_data:
-            if row.fname in fnames:
-                files_by_tags[tuple(sorted(row.tags))].append(row.fname)
+            files_by_tags[tuple(sorted(row.tags))].append(row.fname)
 
         return files_by_tags
 
     def get_tags(self):
         """
-        Returns sorted list of tags
+        Returns sorted list of tags in use
         """
-        # TODO: This should be optimized
-        existing_data = self.metadata.get(['fname', 'tags'])
-
-        tags = set()
-        for row in existing_data:
-            tags |= set(row.tags)
+        return [row.tag for row in self.get_tag_counts()]
 
-        return sorted(tags)
+    def get_tag_counts(self):
+        """
+        Returns [(tag, file_count), ...] sorted by tag for tags in use
+        """
+        return self.tag.get(["tag", "file_count"], clause=("file_count > 0", []),
+                            order_by=["tag"])
 
 def update_metadata(files):
     with store.batch():
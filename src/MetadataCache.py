@@ -0,0 +1,99 @@
+from collections import OrderedDict
+import threading
+
+import Config
+from Storage import LazyJson
+
+def approx_size(value):
+    """Rough number of bytes held by value, a cached query result"""
+    if isinstance(value, str):
+        return 50 + len(value)
+    if isinstance(value, LazyJson):
+        return 100 + len(value.raw)
+    if isinstance(value, (tuple, list)):
+        return 60 + sum(8 + approx_size(item) for item in value)
+    if isinstance(value, dict):
+        return 240 + sum(100 + approx_size(key) + approx_size(item)
+                         for key, item in value.items())
+    return 32
+
+class MetadataCache():
+    """
+    LRU cache of query results in front of a StorePool.
+
+    Every lookup checks StorePool.data_version() (one PRAGMA on an idle
+    connection) and drops all entries when the database changed since they
+    were computed, whether through this process' writer or another process.
+
+    cache = MetadataCache(pool)
+    tags = cache.get(("tags",), lambda store: store.get_tags())
+
+    Cached values are shared between requests and must not be modified.
+    The cache holds at most max_entries values and max_bytes bytes, going by
+    approx_size(). /db pages can hold 1000 rows with exif data.
+    """
+    def __init__(self, pool, max_entries=Config.metadata_cache_size,
+                 max_bytes=Config.metadata_cache_bytes):
+        self.pool = pool
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> (value, approx_size(value))
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.version = None
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key, compute):
+        """
+        Returns the cached value for key. On a miss, runs compute(store)
+        with a reader Store and caches the result
+
+        key : tuple
+            Hashable. Must identify everything compute depends on
+        """
+        # Read the version before computing: a commit racing with compute()
+        # can only make the value newer than the version it is cached under
+        version = self.pool.data_version()
+        with self.lock:
+            if version != self.version:
+                if self.entries:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.bytes = 0
+                self.version = version
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            self.misses += 1
+
+        with self.pool.reader() as store:
+            value = compute(store)
+        size = approx_size(value)
+
+        with self.lock:
+            if version == self.version and size <= self.max_bytes:
+                if key in self.entries:
+                    self.bytes -= self.entries[key][1]
+                self.entries[key] = (value, size)
+                self.bytes += size
+                while self.entries and (len(self.entries) > self.max_entries or
+                                        self.bytes > self.max_bytes):
+                    self.bytes -= self.entries.popitem(last=False)[1][1]
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "invalidations": self.invalidations,
+                    "entries": len(self.entries),
+                    "max_entries": self.max_entries,
+                    "bytes": self.bytes,
+                    "max_bytes": self.max_bytes,
+                }
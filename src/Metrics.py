@@ -0,0 +1,229 @@
+"""
+Latency histograms and gauges, served in the Prometheus text format by
+/metrics.
+
+Recording an event only appends (labels, value) to a deque, which is
+thread safe without a lock. Observations are sorted into buckets in batches
+of Histogram.DRAIN_SIZE, or when /metrics is scraped.
+
+    start = time.perf_counter()
+    ...
+    Metrics.tool_seconds.observe(("convert",), time.perf_counter() - start)
+"""
+import bisect
+from collections import deque
+import re
+import threading
+import time
+
+# name -> Histogram or Gauge, in registration order
+registry = {}
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Histogram():
+    DRAIN_SIZE = 4096
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = list(buckets)
+        # (labels, value) not counted yet
+        self.pending = deque()
+        self.lock = threading.Lock()
+        # label values -> [count per bucket (last one is +Inf), sum]
+        self.series = {}
+        # Other object with pending observations for this histogram, see
+        # SqlStatements
+        self.feeder = None
+        registry[name] = self
+
+    def observe(self, labels, value):
+        """
+        labels : tuple
+            Values for label_names, in order
+        """
+        pending = self.pending
+        pending.append((labels, value))
+        if len(pending) >= self.DRAIN_SIZE:
+            self.drain()
+
+    def add(self, labels, value):
+        """Counts one observation. The caller holds self.lock"""
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def add_many(self, labels, values):
+        """Counts observations. The caller holds self.lock"""
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0]
+        # Sorting is done in C. Bucketing is then one bisect per bucket
+        # instead of one per value
+        values = sorted(values)
+        counts = series[0]
+        below = 0
+        for idx, bound in enumerate(self.buckets):
+            upto = bisect.bisect_right(values, bound)
+            counts[idx] += upto - below
+            below = upto
+        counts[-1] += len(values) - below
+        series[1] += sum(values)
+
+    def drain(self):
+        """Counts pending observations"""
+        if self.feeder:
+            self.feeder.drain()
+        with self.lock:
+            popleft = self.pending.popleft
+            add = self.add
+            for _ in range(len(self.pending)):
+                add(*popleft())
+
+    def totals(self):
+        """{labels: (count, sum)}"""
+        self.drain()
+        with self.lock:
+            return {labels: (sum(counts), total)
+                    for labels, (counts, total) in self.series.items()}
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help_text),
+                 "# TYPE %s histogram" % self.name]
+        self.drain()
+        with self.lock:
+            series = [(labels, list(counts), total)
+                      for labels, (counts, total) in self.series.items()]
+
+        for labels, counts, total in sorted(series):
+            label_str = ",".join('%s="%s"' % (name, escape(value))
+                                 for name, value in zip(self.label_names, labels))
+            sep = "," if label_str else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += count
+                lines.append('%s_bucket{%s%sle="%s"} %d' %
+                             (self.name, label_str, sep, bound, cumulative))
+            lines.append("%s_sum{%s} %r" % (self.name, label_str, total))
+            lines.append("%s_count{%s} %d" % (self.name, label_str, cumulative))
+        return lines
+
+class Gauge():
+    """Value read from fn() when /metrics is scraped"""
+    def __init__(self, name, help_text, fn, typ="gauge"):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+        self.typ = typ
+        registry[name] = self
+
+    def render(self):
+        return ["# HELP %s %s" % (self.name, self.help_text),
+                "# TYPE %s %s" % (self.name, self.typ),
+                "%s %r" % (self.name, self.fn())]
+
+def render():
+    """All metrics in the Prometheus text format"""
+    lines = []
+    for metric in list(registry.values()):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+SECONDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROWS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+request_seconds = Histogram("filebrowser_request_seconds",
+                            "Time spent in Flask handlers",
+                            ("route", "method", "status"), SECONDS)
+sql_seconds = Histogram("filebrowser_sql_seconds",
+                        "Time spent in SQL statements, including fetching rows",
+                        ("statement",), SECONDS)
+sql_rows = Histogram("filebrowser_sql_rows",
+                     "Rows returned or modified by SQL statements",
+                     ("statement",), ROWS)
+tool_seconds = Histogram("filebrowser_tool_seconds",
+                         "Time spent running external tools",
+                         ("tool",), SECONDS)
+thumbnail_seconds = Histogram("filebrowser_thumbnail_seconds",
+                              "Time spent making thumbnails, including external tools",
+                              ("engine",), SECONDS)
+hash_seconds = Histogram("filebrowser_hash_seconds",
+                         "Time spent hashing files",
+                         ("function",), SECONDS)
+
+class SqlStatements():
+    """
+    Feeds sql_seconds and sql_rows. observe_sql() only appends to deques
+    kept per statement text, drain() buckets them in bulk, see
+    Histogram.add_many.
+
+    Statements are labelled by verb and table ("select Metadata"), not by
+    their text: /db?fields= and searches produce endless distinct texts.
+    """
+    MAX_STATEMENTS = 4096
+    TABLE = {
+            "select": re.compile(r"\bfrom\s+(\w+)", re.I),
+            "delete": re.compile(r"\bfrom\s+(\w+)", re.I),
+            "insert": re.compile(r"\binto\s+(\w+)", re.I),
+            "update": re.compile(r"^\s*update\s+(\w+)", re.I),
+        }
+
+    def __init__(self, seconds, rows):
+        self.seconds = seconds
+        self.rows = rows
+        seconds.feeder = rows.feeder = self
+        self.lock = threading.Lock()
+        # statement text -> (labels, seconds deque, rows deque). Entries are
+        # never removed, so observe_sql() can't append to a dropped one
+        self.pending = {}
+        # labels -> entry, for statements beyond MAX_STATEMENTS
+        self.overflow = {}
+
+    def shape(self, statement):
+        """(verb and table of statement,)"""
+        verb = statement.split(None, 1)[0].lower() if statement.strip() else ""
+        match = self.TABLE[verb].search(statement) if verb in self.TABLE else None
+        return (verb + " " + match.group(1) if match else verb,)
+
+    def entry(self, statement):
+        """Slow path of observe_sql(), the first time statement is seen"""
+        labels = self.shape(statement)
+        with self.lock:
+            if len(self.pending) < self.MAX_STATEMENTS:
+                return self.pending.setdefault(statement, (labels, deque(), deque()))
+            return self.overflow.setdefault(labels, (labels, deque(), deque()))
+
+    def drain(self):
+        def take(values):
+            popleft = values.popleft
+            return [popleft() for _ in range(len(values))]
+
+        with self.lock, self.seconds.lock, self.rows.lock:
+            for labels, seconds, rows in list(self.pending.values()) + \
+                                         list(self.overflow.values()):
+                if seconds:
+                    self.seconds.add_many(labels, take(seconds))
+                if rows:
+                    self.rows.add_many(labels, take(rows))
+
+sql_statements = SqlStatements(sql_seconds, sql_rows)
+sql_pending = sql_statements.pending
+
+def observe_sql(statement, start, rows=-1):
+    entry = sql_pending.get(statement) or sql_statements.entry(statement)
+    entry[1].append(time.perf_counter() - start)
+    if rows >= 0:
+        entry[2].append(rows)
+    if len(entry[1]) >= Histogram.DRAIN_SIZE:
+        sql_statements.drain()
+
+def observe_tool(cmd, start):
+    """cmd : list(str) passed to subprocess"""
+    tool = cmd[0].rsplit("/", 1)[-1]
+    tool_seconds.observe((tool,), time.perf_counter() - start)
@@ -1,5 +1,6 @@
 import itertools
 
+from Storage import all_of
 from Utils import (
         ErrorResponse,
     )
@@ -13,6 +14,16 @@ class SearchParam:
     def match(self, field):
         raise NotImplementedError
 
+    def clause(self, indexed=False):
+        """
+        Returns (sql, values): a condition on Metadata columns that is true
+        exactly when match() returns True
+
+        indexed : bool
+            Use the MetadataSearch trigram index
+        """
+        raise NotImplementedError
+
     @staticmethod
     def impl(tok):
         if tok.lower() in {"tagged", "!tagged"}:
@@ -55,6 +66,19 @@ class SubstrParam(SearchParam):
 
         return field_res
 
+    def clause(self, indexed=False):
+        if indexed:
+            sql = ("fname in (select fname from MetadataSearchKey where id in "
+                   "(select rowid from MetadataSearch where MetadataSearch match ?))")
+            values = ['"%s"' % self.tok.replace('"', '""')]
+        else:
+            sql = ("(instr(file_ts, ?) > 0 or "
+                   "exists (select 1 from json_each(tags) where instr(json_each.value, ?) > 0))")
+            values = [self.tok, self.tok]
+        if self.negate:
+            sql = "not " + sql
+        return (sql, values)
+
 class TaggedParam(SearchParam):
     """Returns True if file is tagged, False otherwise.
     Behavior tweaked by leading "!"
@@ -65,6 +89,10 @@ class TaggedParam(SearchParam):
     def match(self, row):
         return bool(row.tags) ^ self.negate
 
+    def clause(self, indexed=False):
+        op = "=" if self.negate else ">"
+        return ("coalesce(json_array_length(tags), 0) %s 0" % op, [])
+
 class Search:
     def __init__(self, search_str):
         self.search_str = search_str
@@ -78,6 +106,20 @@ class Search:
 
         self.filtering = bool(self.params)
 
+    def clause(self, indexed=False):
+        """
+        Returns (sql, values) to evaluate the search inside sqlite. Same
+        result as match(), which is kept as the reference implementation
+
+        indexed : bool
+            Answer substring searches from the MetadataSearch trigram index.
+            See Store.search_indexed
+        """
+        assert not self.error_response
+        assert self.filtering
+
+        return all_of([param.clause(indexed) for param in self.params])
+
     def match(self, row):
         assert not self.error_response
         assert self.filtering
@@ -0,0 +1,181 @@
+"""
+Near-duplicate images by perceptual hash.
+
+Metadata.phash is a 64 bit difference hash (dHash) of the thumbnail, stored
+as 16 hex digits. Re-exported, resized or re-compressed copies of a photo
+have hashes a few bits apart. Hashes are searched by Hamming distance with
+multi-index hashing, see MultiIndex.
+
+Needs Pillow, like Thumbnail.py. Without it phash stays empty.
+"""
+import itertools
+import threading
+
+import Config
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+HASH_SIZE = 8
+
+def dhash(img):
+    """Returns the dHash of a PIL image as a hex string"""
+    img = img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    pixels = list(img.getdata())
+    value = 0
+    for y in range(HASH_SIZE):
+        row = pixels[y * (HASH_SIZE + 1):(y + 1) * (HASH_SIZE + 1)]
+        for left, right in zip(row, row[1:]):
+            value = (value << 1) | (left > right)
+    return "%016x" % value
+
+def dhash_file(path):
+    """dHash of the image at path (or in a file object). None if it can't
+    be read"""
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as img:
+            return dhash(img)
+    except Exception as exc:
+        print("Failed to hash image", path, exc)
+        return None
+
+def distance(hash1, hash2):
+    return bin(hash1 ^ hash2).count("1")
+
+class MultiIndex():
+    """
+    Maps 64 bit hashes to values, searchable by Hamming distance.
+
+    Multi-index hashing: the hash is split into CHUNKS chunks and each chunk
+    indexes a dict. Two hashes within distance k differ in at most
+    k // CHUNKS bits in at least one chunk (pigeonhole), so a search only
+    looks at the buckets of chunk values that close to the query's chunks
+    instead of at every hash.
+    """
+    CHUNKS = 4
+    CHUNK_BITS = 64 // CHUNKS
+    # Beyond this many bits per chunk, probing costs more than a linear scan
+    MAX_CHUNK_RADIUS = 3
+
+    def __init__(self):
+        # value -> key
+        self.keys = {}
+        # per chunk: chunk value -> set(values)
+        self.buckets = [{} for _ in range(self.CHUNKS)]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def chunks(self, key):
+        mask = (1 << self.CHUNK_BITS) - 1
+        return [(key >> (idx * self.CHUNK_BITS)) & mask
+                for idx in range(self.CHUNKS)]
+
+    def add(self, key, value):
+        """Maps value to key, replacing its previous key"""
+        self.remove(value)
+        self.keys[value] = key
+        for bucket, chunk in zip(self.buckets, self.chunks(key)):
+            bucket.setdefault(chunk, set()).add(value)
+
+    def remove(self, value):
+        key = self.keys.pop(value, None)
+        if key is None:
+            return
+        for bucket, chunk in zip(self.buckets, self.chunks(key)):
+            values = bucket[chunk]
+            values.discard(value)
+            if not values:
+                del bucket[chunk]
+
+    def neighbours(self, chunk, radius):
+        """Chunk values within radius bits of chunk"""
+        for bits in range(radius + 1):
+            for flips in itertools.combinations(range(self.CHUNK_BITS), bits):
+                value = chunk
+                for bit in flips:
+                    value ^= 1 << bit
+                yield value
+
+    def search(self, key, max_distance):
+        """Returns [(distance, value), ...] sorted by distance"""
+        radius = max_distance // self.CHUNKS
+        if radius > self.MAX_CHUNK_RADIUS:
+            candidates = self.keys
+        else:
+            candidates = set()
+            for bucket, chunk in zip(self.buckets, self.chunks(key)):
+                for value in self.neighbours(chunk, radius):
+                    candidates.update(bucket.get(value, ()))
+
+        result = []
+        for value in candidates:
+            dist = distance(key, self.keys[value])
+            if dist <= max_distance:
+                result.append((dist, value))
+        result.sort()
+        return result
+
+class SimilarIndex():
+    """
+    MultiIndex of the phash of every file, kept up to date with Metadata
+    """
+    def __init__(self, data_version=None):
+        """
+        data_version : callable
+            StorePool.data_version. The phashes are only read again after
+            it changed. Without it they are read on every call
+        """
+        self.data_version = data_version
+        self.lock = threading.Lock()
+        self.version = None
+        self.index = MultiIndex()
+        # fname -> phash
+        self.phashes = {}
+
+    def refresh(self, store):
+        # Read the version first, see MetadataCache.get
+        version = self.data_version() if self.data_version else None
+        if version is not None and version == self.version:
+            return
+        phashes = {row.fname: int(row.phash, 16) for row in store.get_phashes()}
+        with self.lock:
+            for fname in self.phashes.keys() - phashes.keys():
+                self.index.remove(fname)
+            for fname, phash in phashes.items():
+                if self.phashes.get(fname) != phash:
+                    self.index.add(phash, fname)
+            self.phashes, self.version = phashes, version
+
+    def similar(self, store, fname, max_distance=None):
+        """
+        Returns [(distance, fname), ...] for files within max_distance of
+        fname, fname excluded. None if fname has no phash
+        """
+        if max_distance is None:
+            max_distance = Config.similar_max_distance
+        self.refresh(store)
+        with self.lock:
+            phash = self.phashes.get(fname)
+            if phash is None:
+                return None
+            matches = self.index.search(phash, max_distance)
+        return [(dist, other) for dist, other in matches if other != fname]
+
+    def pairs(self, store, max_distance=None):
+        """Returns [(fname1, fname2, distance), ...] with fname1 < fname2"""
+        if max_distance is None:
+            max_distance = Config.similar_max_distance
+        self.refresh(store)
+        result = []
+        with self.lock:
+            for fname, phash in self.phashes.items():
+                for dist, other in self.index.search(phash, max_distance):
+                    if fname < other:
+                        result.append((fname, other, dist))
+        result.sort()
+        return result
@@ -1,7 +1,14 @@
 from collections import namedtuple
+import itertools
 import json
 import sqlite3
-from Utils import trace
+import time
+
+from Metrics import observe_sql
+from Utils import (
+        trace,
+        trace_sql,
+)
 
 # -------------------------------------
 # Storage cell types
@@ -44,23 +51,119 @@ class Bool(Field):
 class Timestamp(Field):
     typ = "timestamp"
 
+class LazyJson():
+    """
+    JSON text read from storage. It is decoded the first time the value is
+    used and written back as is if it is stored again without being decoded.
+    """
+    __slots__ = ("raw", "_value")
+    _undecoded = object()
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._value = LazyJson._undecoded
+
+    @property
+    def value(self):
+        if self._value is LazyJson._undecoded:
+            self._value = json.loads(self.raw)
+        return self._value
+
+    def get(self, key, default=None):
+        return self.value.get(key, default)
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __contains__(self, key):
+        return key in self.value
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __bool__(self):
+        return bool(self.value)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyJson):
+            other = other.value
+        return self.value == other
+
+    def __repr__(self):
+        return "LazyJson(%r)" % self.raw
+
 class Json(Field):
     typ = "text"
 
+    def __init__(self, name, qualifier=None, lazy=False):
+        """
+        lazy : bool
+            Decode to LazyJson instead of decoding on every read. Use for
+            large values that most readers don't look at
+        """
+        super(Json, self).__init__(name, qualifier=qualifier)
+        self.lazy = lazy
+
     def encode(self, value):
+        if isinstance(value, LazyJson):
+            return value.raw
         return json.dumps(value)
 
     def decode(self, value):
+        if value is None:
+            return None
+        if self.lazy:
+            return LazyJson(value)
         return json.loads(value)
 
+def plain(value):
+    """Value ready for JSON serialization"""
+    if isinstance(value, LazyJson):
+        return value.value
+    return value
+
+# -------------------------------------
+# Storage indexes
+class Index():
+    def __init__(self, *columns, unique=False):
+        assert columns
+        self.columns = columns
+        self.unique = unique
+
+    def name(self, table):
+        return "_".join((table,) + self.columns)
+
+    def create_cmd(self, table, unique=None):
+        # pylint: disable=unused-variable,possibly-unused-variable
+        unique = self.unique if unique is None else unique
+        unique_str = "unique " if unique else ""
+        name = self.name(table)
+        columns = ", ".join(self.columns)
+        return ("create {unique_str}index if not exists {name} on {table} ({columns});".format(**locals()),)
+
+# -------------------------------------
+# SQL conditions as (sql, values) tuples
+def all_of(clauses):
+    """Combines (sql, values) clauses with 'and'. None if clauses is empty"""
+    if not clauses:
+        return None
+    sql = " and ".join("(%s)" % c[0] for c in clauses)
+    values = list(itertools.chain.from_iterable(c[1] for c in clauses))
+    return (sql, values)
+
 # -------------------------------------
 # Storage tables
 class Table():
     fields = []
-    def __init__(self, cursor):
+    indexes = []
+    def __init__(self, cursor, create=True):
         self.cursor = cursor
         self.name = self.__class__.__name__
-        self.create()
+        if create:
+            self.create()
         self.field_by_name = {field.name: field for field in self.fields}
 
     @classmethod
@@ -80,8 +183,19 @@ class Table():
         return {field.name: idx for idx, field in enumerate(cls.fields)}
 
     def execute(self, *cmd):
-        trace(cmd)
-        return self.cursor.execute(*cmd)
+        trace_sql(cmd)
+        start = time.perf_counter()
+        result = self.cursor.execute(*cmd)
+        observe_sql(cmd[0], start, self.cursor.rowcount)
+        return result
+
+    def fetchall(self, *cmd):
+        """execute() and fetch all rows. Timed including the fetch"""
+        trace_sql(cmd)
+        start = time.perf_counter()
+        rows = self.cursor.execute(*cmd).fetchall()
+        observe_sql(cmd[0], start, len(rows))
+        return rows
 
     @property
     def row_type(self):
@@ -91,18 +205,32 @@ class Table():
                         [row.name for row in self.fields]))
         return getattr(self, "type_")
 
-    def get(self, cols, where=None, group_by=None, order_by=None):
+    def get(self, cols, where=None, group_by=None, order_by=None,
+            clause=None, limit=None):
+        """
+        Arguments
+        ---------
+        where : dict
+            Column values to match exactly
+        clause : (str, list)
+            Additional SQL condition and its bound values. ANDed with where
+        limit : int
+            Maximum number of rows to return
+        """
         # pylint: disable=unused-variable,possibly-unused-variable
         where = where or {}
         group_by = group_by or []
-        values = []
 
         cols_str = ", ".join(cols)
         table = self.name
         cmd = "select {cols_str} from {table}"
-        if where:
-            where_unspec = " and ".join("%s = ?" % w for w in where)
-            values = self.encoded_values(where)
+        conditions = ["%s = ?" % w for w in where]
+        values = self.encoded_values(where)
+        if clause:
+            conditions.append("(%s)" % clause[0])
+            values.extend(clause[1])
+        if conditions:
+            where_unspec = " and ".join(conditions)
             cmd += " where {where_unspec}"
         if group_by:
             group_by = ", ".join(group_by)
@@ -110,35 +238,50 @@ class Table():
         if order_by:
             order_by = ", ".join(order_by)
             cmd += " order by {order_by}"
+        if limit is not None:
+            cmd += " limit ?"
+            values.append(limit)
         cmd += ";"
 
-        self.execute(cmd.format(**locals()), values)
+        rows = self.fetchall(cmd.format(**locals()), values)
         # pylint: disable=not-callable
         def deserialized_row(row, row_type, fields):
             return row_type(*[field.decode(val) for field, val in zip(fields, row)])
 
         if cols == "*":
-            return [deserialized_row(row, self.row_type, self.fields) for row in self.cursor.fetchall()]
+            return [deserialized_row(row, self.row_type, self.fields) for row in rows]
 
         row_type = namedtuple(self.name + "Row", cols)
-        col_fields = [field for field in self.fields if field.name in cols]
-        return [deserialized_row(row, row_type, col_fields) for row in self.cursor.fetchall()]
+        col_fields = [self.field_by_name[col] for col in cols]
+        return [deserialized_row(row, row_type, col_fields) for row in rows]
 
-    def count(self, where=None, group_by=None):
+    def count(self, where=None, group_by=None, clause=None):
+        """
+        Arguments
+        ---------
+        where : dict
+            Column values to match exactly
+        clause : (str, list)
+            Additional SQL condition and its bound values. ANDed with where
+        """
+        # pylint: disable=unused-variable,possibly-unused-variable
+        where = where or {}
         table = self.name
         cmd = "select count(*) from {table}"
-        if where:
-            where_unspec = " and ".join("%s = ?" % w for w in where)
-            values = self.encoded_values(where)
+        conditions = ["%s = ?" % w for w in where]
+        values = self.encoded_values(where)
+        if clause:
+            conditions.append("(%s)" % clause[0])
+            values.extend(clause[1])
+        if conditions:
+            where_unspec = " and ".join(conditions)
             cmd += " where {where_unspec}"
         if group_by:
             group_by = ", ".join(group_by)
             cmd += " group by {group_by}"
         cmd += ";"
 
-        self.execute(cmd.format(**locals()), values)
-
-        return self.cursor.fetchall()[0][0]
+        return self.fetchall(cmd.format(**locals()), values)[0][0]
 
     def create_cmd(self):
         # pylint: disable=unused-variable,possibly-unused-variable
@@ -155,6 +298,30 @@ class Table():
         print("Created table", self.name)
         return res
 
+    def existing_columns(self):
+        return {row[1] for row in
+                self.fetchall("pragma table_info({});".format(self.name))}
+
+    def add_missing_columns(self):
+        existing = self.existing_columns()
+        for field in self.fields:
+            if field.name in existing:
+                continue
+            self.execute("alter table {} add column {};".format(self.name,
+                                                               field.create_desc()))
+            print("Added column", self.name, field.name)
+
+    def create_indexes(self):
+        for index in self.indexes:
+            try:
+                self.execute(*index.create_cmd(self.name))
+            except sqlite3.IntegrityError as exc:
+                # Existing rows violate the constraint. An index is still
+                # better than a table scan
+                trace("Failed to create unique index", index.name(self.name),
+                      "Error:", exc)
+                self.execute(*index.create_cmd(self.name, unique=False))
+
     def encoded_values(self, dic):
         return [self.field_by_name[k].encode(v) for k, v in dic.items()]
 
@@ -200,3 +367,42 @@ class Table():
         """
         cmd_args = self.update_cmd(values, where)
         return self.execute(*cmd_args)
+
+# -------------------------------------
+# Schema migrations
+def migrate(cursor, tables, migrations):
+    """
+    Brings the database schema up to date. The schema version is stored in
+    PRAGMA user_version and equals len(migrations).
+
+    When the database is behind, missing tables, columns and indexes are
+    created for all tables first. Then migrations[version:] run in order,
+    entry N upgrading the data from version N to N + 1. Entries can be None
+    if the version only changed the declared schema.
+
+    Arguments
+    ---------
+    tables : list(Table)
+        Tables instantiated with create=False
+    migrations : list(callable(cursor) or None)
+
+    Returns the schema version the database was at before migrating.
+    """
+    cursor.execute("pragma user_version;")
+    version = cursor.fetchone()[0]
+    latest = len(migrations)
+    if version >= latest:
+        return version
+
+    trace("Migrating schema from version", version, "to", latest)
+    for table in tables:
+        table.create()
+        table.add_missing_columns()
+        table.create_indexes()
+
+    for migration in migrations[version:]:
+        if migration:
+            migration(cursor)
+
+    cursor.execute("pragma user_version = {};".format(latest))
+    return version
@@ -0,0 +1,86 @@
+from contextlib import contextmanager
+import queue
+import sqlite3
+import threading
+
+import Config
+from Metadata import Store
+from Utils import debug
+
+class StorePool():
+    """
+    Shares Store connections between requests instead of opening a new
+    sqlite3 connection (and re-checking the schema) on every request.
+
+    The schema is initialized once when the pool is created. Read
+    connections are pooled and handed out to one user at a time. All
+    modifications go through a single writer Store guarded by a lock.
+
+    pool = StorePool()
+
+    with pool.reader() as store:
+        store.get_db_data_fname(fname)
+
+    with pool.writer() as store:
+        store.process(path)
+    """
+    def __init__(self, fname=Config.metadata_file, max_readers=8):
+        self.fname = fname
+        self.max_readers = max_readers
+        self.readers = queue.LifoQueue()
+
+        self.writer_lock = threading.Lock()
+        self.writer_store = Store(self.fname, init_schema=True,
+                                  check_same_thread=False)
+
+        # Readers don't block the writer (and vice versa) in WAL mode
+        self.writer_store.cursor.execute("pragma journal_mode=wal;").fetchall()
+
+        # Never writes, so its data_version changes with every commit by
+        # any other connection, including the writer and other processes
+        self.version_lock = threading.Lock()
+        self.version_conn = sqlite3.connect(self.fname, check_same_thread=False)
+
+    def connect(self):
+        return Store(self.fname, init_schema=False, check_same_thread=False)
+
+    @contextmanager
+    def reader(self):
+        try:
+            store = self.readers.get_nowait()
+        except queue.Empty:
+            debug("StorePool: opening new reader")
+            store = self.connect()
+
+        try:
+            yield store
+        finally:
+            if self.readers.qsize() < self.max_readers:
+                self.readers.put(store)
+            else:
+                store.close()
+
+    @contextmanager
+    def writer(self):
+        with self.writer_lock:
+            try:
+                yield self.writer_store
+            except:
+                self.writer_store.rollback()
+                raise
+
+    def data_version(self):
+        """Changes whenever the database changed. See MetadataCache"""
+        with self.version_lock:
+            return self.version_conn.execute("pragma data_version;").fetchone()[0]
+
+    def close(self):
+        with self.version_lock:
+            self.version_conn.close()
+        with self.writer_lock:
+            self.writer_store.close()
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                break
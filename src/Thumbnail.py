@@ -0,0 +1,163 @@
+"""
+In-process thumbnail generation with Pillow.
+
+Each source image is decoded once (JPEGs are decoded directly at a reduced
+scale) and written in every size of Config.thumbnail_sizes. The smallest
+size is the thumbnail stored in Metadata.thumbnail. The other sizes sit next
+to it with the size in the name:
+
+    IMG_0001.jpg.webp         240px
+    IMG_0001.jpg.480.webp     480px
+    IMG_0001.jpg.1200.webp   1200px
+
+With Config.thumbnail_store = "pack" the thumbnails are kept in
+ThumbnailStore packs instead of thumbnail_dir. Use read() rather than
+opening thumbnail files directly.
+
+Pillow is optional. Without it Store.thumbnail falls back to convert.
+"""
+import io
+import os
+
+import Config
+from ThumbnailStore import ThumbnailStore
+
+try:
+    from PIL import (
+            Image,
+            ImageDraw,
+            ImageFont,
+            ImageOps,
+            features,
+    )
+except ImportError:
+    Image = None
+
+def available():
+    return Image is not None
+
+def file_format():
+    """Returns (Pillow format, extension)"""
+    if not hasattr(file_format, "fmt"):
+        if features.check("webp"):
+            file_format.fmt = ("WEBP", ".webp")
+        else:
+            file_format.fmt = ("JPEG", ".jpg")
+    return file_format.fmt
+
+def default_size():
+    return min(Config.thumbnail_sizes)
+
+def sized_name(thumbnail, size):
+    """Name of the thumbnail file for size, given the Metadata.thumbnail value"""
+    if size == default_size():
+        return thumbnail
+    base, ext = os.path.splitext(thumbnail)
+    return "%s.%d%s" % (base, size, ext)
+
+def all_names(thumbnail):
+    return [sized_name(thumbnail, size) for size in Config.thumbnail_sizes]
+
+def packed():
+    return Config.thumbnail_store == "pack"
+
+def pack_store():
+    """The ThumbnailStore of this process"""
+    # sqlite connections can't be used across fork(), e.g. by
+    # UpdateScript.py --scan workers
+    if getattr(pack_store, "pid", None) != os.getpid():
+        pack_store.store = ThumbnailStore()
+        pack_store.pid = os.getpid()
+    return pack_store.store
+
+def read(name):
+    """Returns the thumbnail file name as bytes, None if it doesn't exist"""
+    if packed():
+        return pack_store().get(name)
+    try:
+        with open(Config.thumbnail_path(name), "rb") as file:
+            return file.read()
+    except OSError:
+        return None
+
+def save(img, name, fmt):
+    if packed():
+        buf = io.BytesIO()
+        img.save(buf, fmt, quality=80)
+        pack_store().put(name, buf.getvalue())
+    else:
+        img.save(Config.thumbnail_path(name), fmt, quality=80)
+
+def store_file(name):
+    """
+    Moves thumbnail_dir/name, e.g. written by convert, into the packs when
+    they are used. Returns name
+    """
+    if name and packed():
+        path = Config.thumbnail_path(name)
+        with open(path, "rb") as file:
+            pack_store().put(name, file.read())
+        os.remove(path)
+    return name
+
+def delete(thumbnail):
+    """Removes the thumbnail in every size"""
+    if packed():
+        pack_store().delete(all_names(thumbnail))
+        return
+
+    for name in all_names(thumbnail):
+        try:
+            os.remove(Config.thumbnail_path(name))
+        except FileNotFoundError:
+            pass
+
+def draw_text(img, text):
+    """Draws text at the bottom center with a shadow, like the convert
+    based thumbnails"""
+    draw = ImageDraw.Draw(img)
+    try:
+        font = ImageFont.load_default(size=max(12, img.height // 12))
+    except TypeError:
+        # Pillow < 10.1
+        font = ImageFont.load_default()
+    left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+    x = (img.width - (right - left)) // 2
+    y = img.height - (bottom - top) - 10
+    draw.text((x + 2, y + 2), text, fill="gray", font=font)
+    draw.text((x, y), text, fill="white", font=font)
+
+def make(srcpath, fname, text=None):
+    """
+    Writes thumbnails of srcpath in all sizes.
+
+    text : str
+        Drawn over every size, e.g. video duration
+
+    Returns the thumbnail name to store in Metadata.thumbnail, None if
+    srcpath couldn't be read as an image
+    """
+    fmt, ext = file_format()
+    thumbnail = fname + ext
+    sizes = sorted(Config.thumbnail_sizes, reverse=True)
+
+    try:
+        with Image.open(srcpath) as src:
+            # JPEG: decode at 1/2, 1/4 or 1/8 scale if that's still big enough
+            src.draft("RGB", (sizes[0], sizes[0]))
+            img = ImageOps.exif_transpose(src)
+            img = img.convert("RGB")
+    except Exception as exc:
+        print("Failed to read image", srcpath, exc)
+        return None
+
+    # Largest first, each size resized from the previous one
+    for size in sizes:
+        img.thumbnail((size, size), Image.LANCZOS)
+        out = img
+        if text:
+            out = img.copy()
+            draw_text(out, text)
+        save(out, sized_name(thumbnail, size), fmt)
+
+    return thumbnail
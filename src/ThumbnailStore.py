@@ -0,0 +1,267 @@
+"""
+Packed thumbnail storage, used when Config.thumbnail_store is "pack".
+
+Thumbnails are appended to a few large pack files instead of being written
+as one small file each:
+
+    thumbnail_packs/
+        index.sqlite3       PackedThumbnail: name -> (pack, offset, length)
+        pack-000001.bin
+        pack-000002.bin     a new pack is started when the last one reaches
+                            Config.thumbnail_pack_size
+
+Packs are only ever appended to. Replacing or deleting a thumbnail only
+changes the index, compact() reclaims the space. Packs are read through
+mmap, so reading a thumbnail is an index lookup and a slice.
+
+Several processes may write (the server and UpdateScript.py workers).
+Appends are serialized with an flock on the pack directory.
+"""
+from contextlib import contextmanager
+import fcntl
+import glob
+import mmap
+import os
+import re
+import sqlite3
+import threading
+
+import Config
+from Storage import (
+        Index,
+        Int,
+        Table,
+        Txt,
+        migrate,
+)
+from Utils import trace
+
+class PackedThumbnail(Table):
+    fields = [
+            Txt("name"),
+            Int("pack"),
+            Int("offset"),
+            Int("length"),
+        ]
+
+    indexes = [
+            Index("name", unique=True),
+            Index("pack"),
+        ]
+
+migrations = [
+        None, # 1: PackedThumbnail
+    ]
+
+class ThumbnailStore():
+    def __init__(self, directory=Config.thumbnail_pack_dir,
+                 pack_size=Config.thumbnail_pack_size):
+        self.directory = directory
+        self.pack_size = pack_size
+        os.makedirs(directory, exist_ok=True)
+
+        # One connection shared by all threads, used under self.lock
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(directory, "index.sqlite3"),
+                                    check_same_thread=False, timeout=60)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute("pragma journal_mode=wal;").fetchall()
+        self.index = PackedThumbnail(self.cursor, create=False)
+        migrate(self.cursor, [self.index], migrations)
+        self.conn.commit()
+
+        # pack -> mmap of the pack file
+        self.maps = {}
+
+    def close(self):
+        with self.lock:
+            for mapped in self.maps.values():
+                mapped.close()
+            self.maps = {}
+            self.cursor.close()
+            self.conn.close()
+
+    def pack_path(self, pack):
+        return os.path.join(self.directory, "pack-%06d.bin" % pack)
+
+    def packs(self):
+        """Pack numbers of the pack files on disk"""
+        packs = []
+        for path in glob.glob(os.path.join(self.directory, "pack-*.bin")):
+            match = re.match(r"pack-(\d+)\.bin$", os.path.basename(path))
+            if match:
+                packs.append(int(match.group(1)))
+        return sorted(packs)
+
+    @contextmanager
+    def appending(self):
+        """Exclusive right to append to packs, across processes"""
+        with open(os.path.join(self.directory, "lock"), "w") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def map(self, pack, end):
+        """mmap of pack covering at least [0, end)"""
+        mapped = self.maps.get(pack)
+        if mapped is None or len(mapped) < end:
+            # New pack, or it grew since it was mapped
+            with open(self.pack_path(pack), "rb") as file:
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            old = self.maps.get(pack)
+            self.maps[pack] = mapped
+            if old is not None:
+                old.close()
+        return mapped
+
+    # -------------------------------------------
+    # Reading
+
+    def get(self, name):
+        """Returns the thumbnail as bytes, None if there is none"""
+        with self.lock:
+            rows = self.index.get(["pack", "offset", "length"],
+                                  where={"name": name})
+            if not rows:
+                return None
+            pack, offset, length = rows[0]
+            try:
+                mapped = self.map(pack, offset + length)
+            except OSError as exc:
+                trace("ThumbnailStore: can't read pack", pack, exc)
+                return None
+            return mapped[offset:offset + length]
+
+    def names(self):
+        with self.lock:
+            return [row.name for row in self.index.get(["name"])]
+
+    # -------------------------------------------
+    # Modifying
+
+    def write(self, items):
+        """
+        Appends thumbnails and points the index at them
+
+        items : list((str name, bytes data))
+        """
+        if not items:
+            return
+        with self.lock, self.appending():
+            packs = self.packs()
+            pack = packs[-1] if packs else 1
+            path = self.pack_path(pack)
+            size = os.path.getsize(path) if packs else 0
+
+            file = open(path, "ab")
+            try:
+                for name, data in items:
+                    if size and size + len(data) > self.pack_size:
+                        file.close()
+                        pack += 1
+                        file = open(self.pack_path(pack), "ab")
+                        size = 0
+                    file.write(data)
+                    self.cursor.execute(
+                            "insert or replace into PackedThumbnail "
+                            "(name, pack, offset, length) values (?, ?, ?, ?);",
+                            [name, pack, size, len(data)])
+                    size += len(data)
+            finally:
+                file.close()
+            self.conn.commit()
+
+    def put(self, name, data):
+        self.write([(name, data)])
+
+    def delete(self, names):
+        with self.lock:
+            for name in names:
+                self.cursor.execute("delete from PackedThumbnail where name = ?;",
+                                    [name])
+            self.conn.commit()
+
+    def compact(self):
+        """
+        Rewrites packs that contain replaced or deleted thumbnails. Returns
+        the number of bytes reclaimed
+        """
+        with self.lock, self.appending():
+            live = dict(self.cursor.execute(
+                    "select pack, sum(length) from PackedThumbnail "
+                    "group by pack;").fetchall())
+            old_packs = [pack for pack in self.packs()
+                         if live.get(pack, 0) < os.path.getsize(self.pack_path(pack))]
+            if not old_packs:
+                return 0
+            reclaimed = sum(os.path.getsize(self.pack_path(pack))
+                            for pack in old_packs) - \
+                        sum(live.get(pack, 0) for pack in old_packs)
+
+            # Copy the live thumbnails into new packs after the last one
+            pack = self.packs()[-1] + 1
+            size = 0
+            file = open(self.pack_path(pack), "wb")
+            try:
+                for old_pack in old_packs:
+                    entries = self.cursor.execute(
+                            "select name, offset, length from PackedThumbnail "
+                            "where pack = ? order by offset;", [old_pack]).fetchall()
+                    if not entries:
+                        continue
+                    mapped = self.map(old_pack, max(offset + length
+                                                    for _, offset, length in entries))
+                    for name, offset, length in entries:
+                        if size and size + length > self.pack_size:
+                            file.close()
+                            pack += 1
+                            file = open(self.pack_path(pack), "wb")
+                            size = 0
+                        file.write(mapped[offset:offset + length])
+                        self.cursor.execute(
+                                "update PackedThumbnail set pack = ?, offset = ? "
+                                "where name = ?;", [pack, size, name])
+                        size += length
+            finally:
+                file.close()
+            self.conn.commit()
+
+            # Readers holding a map of an old pack keep it until they remap
+            for old_pack in old_packs:
+                mapped = self.maps.pop(old_pack, None)
+                if mapped is not None:
+                    mapped.close()
+                os.remove(self.pack_path(old_pack))
+
+            trace("ThumbnailStore: compacted", len(old_packs), "packs, reclaimed",
+                  reclaimed, "bytes")
+            return reclaimed
+
+    def import_dir(self, directory=Config.thumbnail_dir, remove=False,
+                   batch_size=500):
+        """
+        Adds every file in directory (the one file per thumbnail layout) to
+        the packs. Returns the number of files imported
+        """
+        count = 0
+        batch = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                with open(entry.path, "rb") as file:
+                    batch.append((entry.name, file.read()))
+                if len(batch) == batch_size:
+                    count += self.import_batch(batch, directory, remove)
+                    batch = []
+        count += self.import_batch(batch, directory, remove)
+        return count
+
+    def import_batch(self, batch, directory, remove):
+        self.write(batch)
+        if remove:
+            for name, _ in batch:
+                os.remove(os.path.join(directory, name))
+        return len(batch)
@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 import argparse
-from collections import defaultdict
+from concurrent.futures import (
+        ProcessPoolExecutor,
+        ThreadPoolExecutor,
+    )
+import itertools
+import json
 import os
 import sqlite3
-import subprocess
-import sys
 
 import Config
-from ExifUtils import from_exif_timestamp
+import Duplicates
+from ExifUtils import (
+        ExifToolError,
+        from_exif_timestamp,
+    )
 import Metadata as MetadataModule
 from Storage import (
         Bool,
@@ -17,6 +24,9 @@ from Storage import (
         Timestamp,
         Txt,
     )
+import Similar
+import Thumbnail
+import Utils
 
 store = MetadataModule.Store()
 
@@ -27,106 +37,171 @@ def delete_path(path):
         print("Failed to deleted", path)
         pass
 
-def upload_path(fname):
-    return os.path.join(Config.upload_dir, fname)
-
-def thumbnail_path(fname):
-    return os.path.join(Config.thumbnail_dir, fname)
-
-def ask(msg, options):
-    inp = None
-    while inp not in options:
-        inp = input(msg)
-
-    return inp
-
-def same_file(fname1, fname2):
-    path1 = upload_path(fname1)
-    path2 = upload_path(fname2)
-    assert(os.path.exists(path1))
-    assert(os.path.exists(path2))
-
-    cmd = ["diff", path1, path2]
-    try:
-        subprocess.check_output(cmd)
-    except:
-        return False
-    return True
-
-def process_possible_duplicates(matches):
-    print("")
-    print("-----------------------")
-
-    for match in matches:
-        print(match.fname)
-
-    print()
-
-    if all(same_file(matches[0].fname, other.fname) for other in matches[1:]):
-        choice = ask("Duplicates detected. (d)elete all but first   (k)eep all  (q)uit? ", {"d", "k", "q"})
-        if choice == "q":
-            print("Quitting")
-            sys.exit(0)
-        if choice == "k":
-            print("Skipping")
-            return
-
-        for match in matches[1:]:
-            try:
-                delete_path(upload_path(match.fname))
-                delete_path(thumbnail_path(match.fname))
-                print("Deleted successfully")
-            except:
-                print("Failed to delete uploaded file or thumbnail")
-
-            store._delete(upload_path(match.fname), match.fname, match)
-
-    else:
-        print("Files are not duplicates. Not sure what to do")
-        choice = ask("(k)eep all  (q)uit? ", {"k", "q"})
-        if choice == "q":
-            print("Quitting")
-            sys.exit(0)
-        if choice == "k":
-            print("Skipping")
-            return
-
 # -----------------------------------------------
 # Update actions
 
-def duplicate_check():
-    all_data = store.get_db_data(deleted=False, reverse=True)
-
-    grouped_data = defaultdict(list)
+def duplicate_check(verify=False, policy=None, report_file="-"):
+    """
+    Writes a JSON report of files with identical content to report_file.
+    With a Duplicates.policies policy, deletes all but one file per group
+    """
+    rows = store.metadata.get(Duplicates.columns, where={"deleted": False})
+    groups = Duplicates.find_duplicates(rows, verify=verify)
+    report = Duplicates.report(groups, policy)
+
+    if policy:
+        with store.batch():
+            for group in report["groups"]:
+                for fname in group["fnames"]:
+                    if fname == group["keep"]:
+                        continue
+                    existing_data = store.get_db_data_fname(fname)
+                    delete_path(Config.upload_path(fname))
+                    if existing_data.thumbnail:
+                        Thumbnail.delete(existing_data.thumbnail)
+                    store._delete(Config.upload_path(fname), fname, existing_data)
+
+    if report_file == "-":
+        print(json.dumps(report, indent=2))
+    else:
+        with open(report_file, "w") as file:
+            json.dump(report, file, indent=2)
 
-    for row in all_data:
-        key = (row.exif['FileSize'],
-               row.hash_sha256)
-        grouped_data[key].append(row)
+def update_thumbnails(fnames):
+    """Regenerates thumbnails, using all cores"""
+    if fnames:
+        entries = [store.get_db_data_fname(fname) for fname in fnames]
+    else:
+        entries = store.get_db_data(deleted=False, cols=["fname", "thumbnail"])
+
+    def make_thumbnail(entry):
+        return MetadataModule.Store.thumbnail(Config.upload_path(entry.fname), entry.fname)
+
+    with ThreadPoolExecutor(os.cpu_count()) as executor, store.batch():
+        for entry, thumbnail in zip(entries, executor.map(make_thumbnail, entries)):
+            old_thumbnail = entry.thumbnail
+            if old_thumbnail != thumbnail and old_thumbnail:
+                Thumbnail.delete(old_thumbnail)
+            store.metadata.update({"thumbnail": thumbnail}, {"fname": entry.fname})
+
+def update_phashes():
+    """Computes Metadata.phash for files that don't have one"""
+    entries = store.metadata.get(["fname", "thumbnail"],
+                                 where={"deleted": False},
+                                 clause=("phash is null and thumbnail is not null", []))
+
+    with ThreadPoolExecutor(os.cpu_count()) as executor, store.batch():
+        phashes = executor.map(lambda entry: MetadataModule.Store.phash(entry.thumbnail),
+                               entries)
+        for entry, phash in zip(entries, phashes):
+            if phash:
+                store.metadata.update({"phash": phash}, {"fname": entry.fname})
+
+def near_duplicates(max_distance, report_file="-"):
+    """Writes a JSON list of [fname1, fname2, distance] of similar images"""
+    pairs = Similar.SimilarIndex().pairs(store, max_distance)
+    if report_file == "-":
+        print(json.dumps(pairs, indent=1))
+    else:
+        with open(report_file, "w") as file:
+            json.dump(pairs, file, indent=1)
 
-    for key, matches in grouped_data.items():
-        if len(matches) == 1:
-            continue
-        
-        process_possible_duplicates(matches)
+def import_thumbnails():
+    """Moves the thumbnail files into the packs"""
+    if not Thumbnail.packed():
+        print('Set thumbnail_store = "pack" in Config.py first')
+        return
+    count = Thumbnail.pack_store().import_dir(Config.thumbnail_dir, remove=True)
+    print("Imported", count, "thumbnails")
 
-def update_thumbnails(fnames):
-    def get_data(fnames):
-        if fnames:
-            for fname in fnames:
-                yield store.get_db_data_fname(fname)
-        else:
-            all_data = store.get_db_data(deleted=False)
-            for item in all_data:
-                yield item
+def compact_thumbnails():
+    if not Thumbnail.packed():
+        print("Thumbnails aren't packed. Nothing to compact")
+        return
+    print("Reclaimed", Thumbnail.pack_store().compact(), "bytes")
 
+def rebuild_search_index():
+    if not store.search_indexed:
+        print("sqlite doesn't support fts5 trigram indexes. Nothing to rebuild")
+        return
     with store.batch():
-        for entry in get_data(fnames):
-            old_thumbnail_path = entry.thumbnail
-            thumbnail_path = MetadataModule.Store.thumbnail(Config.upload_path(entry.fname), entry.fname)
-            if old_thumbnail_path != thumbnail_path and old_thumbnail_path:
-                delete_path(old_thumbnail_path)
-            store.metadata.update({"thumbnail": thumbnail_path}, {"fname": entry.fname})
+        store.reindex_search(None)
+
+def scan_worker_init(log_records):
+    # Each worker process reads through its own connection and logs
+    # through this process
+    global store
+    Utils.setup_worker_logging(log_records)
+    store = MetadataModule.Store(init_schema=False)
+
+def scan_prepare(path):
+    fname = os.path.split(path)[1]
+    existing_data = store.get_db_data_fname(fname)
+    try:
+        return MetadataModule.Store.prepare(path, existing_data)
+    except (ExifToolError, OSError) as exc:
+        # Unreadable, or removed since the directory was listed. The rest
+        # of the scan goes on
+        print("Skipping", path, exc)
+        return (None, fname, None)
+
+def scan(batch_size=500, processes=None):
+    """
+    Brings the database up to date with the files in Config.upload_dir.
+
+    Files whose size and mtime match the database (and that aren't marked
+    deleted) are skipped without running exiftool. The others go through
+    Store.prepare on all cores and are written batch_size files per commit.
+    Files missing from the directory are marked deleted.
+
+    processes : int
+        Worker processes for Store.prepare. Default: one per core. 0 runs
+        it in this process
+    """
+    known = {row.fname: row for row in
+             store.metadata.get(["fname", "deleted", "file_size", "file_mtime_ns"])}
+
+    paths = []
+    present = set()
+    with os.scandir(Config.upload_dir) as entries:
+        for entry in entries:
+            # Hidden files are uploads still being written, see main.upload
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            present.add(entry.name)
+            stat = entry.stat()
+            row = known.get(entry.name)
+            if row and not row.deleted and row.file_size == stat.st_size and \
+                    row.file_mtime_ns == stat.st_mtime_ns:
+                continue
+            paths.append(entry.path)
+
+    missing = [("delete", fname, None) for fname, row in known.items()
+               if not row.deleted and fname not in present]
+
+    print("Scanned", len(present), "files.", len(paths), "new or modified,",
+          len(missing), "missing")
+
+    if processes == 0:
+        apply_changes(itertools.chain(map(scan_prepare, paths), missing), batch_size)
+        return
+
+    with ProcessPoolExecutor(processes or os.cpu_count(),
+                             initializer=scan_worker_init,
+                             initargs=(Utils.worker_log_queue(),)) as executor:
+        apply_changes(itertools.chain(executor.map(scan_prepare, paths, chunksize=16),
+                                      missing),
+                      batch_size)
+
+def apply_changes(changes, batch_size):
+    """Writes Store.prepare results, batch_size per commit"""
+    while True:
+        chunk = list(itertools.islice(changes, batch_size))
+        if not chunk:
+            break
+        with store.batch():
+            for change in chunk:
+                store.apply(change)
 
 # -----------------------------------
 # Map data to this new Metadata
@@ -190,7 +265,34 @@ def main(args):
 
     if args.duplicate_check:
         assert not args.paths
-        duplicate_check()
+        duplicate_check(verify=args.verify, policy=args.auto_delete,
+                        report_file=args.report)
+        return
+
+    if args.import_thumbnails:
+        assert not args.paths
+        import_thumbnails()
+        return
+
+    if args.compact_thumbnails:
+        assert not args.paths
+        compact_thumbnails()
+        return
+
+    if args.rebuild_search_index:
+        assert not args.paths
+        rebuild_search_index()
+        return
+
+    if args.near_duplicates:
+        assert not args.paths
+        update_phashes()
+        near_duplicates(args.max_distance, report_file=args.report)
+        return
+
+    if args.scan:
+        assert not args.paths
+        scan()
         return
 
     if args.update_thumbnails:
@@ -201,9 +303,41 @@ def main(args):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--duplicate-check",
-                        action="store_true")
+                        action="store_true",
+                        help="Report files with identical content as JSON")
+    parser.add_argument("--verify", action="store_true",
+                        help="--duplicate-check: compare files byte by byte "
+                             "after hashing")
+    parser.add_argument("--report", metavar="FILE", default="-",
+                        help="--duplicate-check, --near-duplicates: write "
+                             "the report to FILE")
+    parser.add_argument("--auto-delete-keep-oldest", dest="auto_delete",
+                        action="store_const", const="keep-oldest",
+                        help="--duplicate-check: delete all but the file "
+                             "added first")
+    parser.add_argument("--auto-delete-keep-newest", dest="auto_delete",
+                        action="store_const", const="keep-newest",
+                        help="--duplicate-check: delete all but the file "
+                             "added last")
     parser.add_argument("-t", "--update-thumbnails",
                         action="store_true")
+    parser.add_argument("--rebuild-search-index",
+                        action="store_true")
+    parser.add_argument("--import-thumbnails", action="store_true",
+                        help="Move thumbnail files into the packed thumbnail "
+                             "store (Config.thumbnail_store = \"pack\")")
+    parser.add_argument("--compact-thumbnails", action="store_true",
+                        help="Reclaim space used by deleted thumbnails in "
+                             "the packed thumbnail store")
+    parser.add_argument("--near-duplicates", action="store_true",
+                        help="Report pairs of similar looking images as JSON")
+    parser.add_argument("--max-distance", type=int,
+                        default=Config.similar_max_distance,
+                        help="--near-duplicates: maximum Hamming distance "
+                             "between perceptual hashes")
+    parser.add_argument("--scan", action="store_true",
+                        help="Add new, update modified and mark missing files "
+                             "in the uploads directory")
     parser.add_argument("--map-data", metavar="NEW_SQLITE3_FILE")
     parser.add_argument("paths", nargs="*")
     args = parser.parse_args()
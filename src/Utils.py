@@ -1,38 +1,141 @@
+import atexit
 import datetime
 from flask import jsonify
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
 import subprocess
+import sys
+import time
+
+import Config
+from Metrics import observe_tool
 
 def now():
     return datetime.datetime.now()
 
-def handle():
-    if not hasattr(handle, "handle"):
-        setattr(handle, "handle", open("trace.log", "a+"))
-    return getattr(handle, "handle")
+logger = logging.getLogger("file-browser")
+logger.setLevel(Config.log_level)
+logger.propagate = False
+
+# Every SQL statement, see Storage.Table.execute
+sql_logger = logging.getLogger("file-browser.sql")
+sql_logger.setLevel(logging.DEBUG if Config.log_sql else logging.INFO)
+
+class StdoutHandler(logging.StreamHandler):
+    """Writes to sys.stdout as it is when the record is written"""
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+def setup_logging():
+    """
+    Sends log records through a queue to a background thread that writes
+    them to stdout and to Config.log_file, so that logging never waits for
+    I/O. Runs once per process. Forked children that didn't call
+    setup_worker_logging() only log to stdout: several processes rotating
+    one file lose records
+    """
+    if getattr(setup_logging, "pid", None) == os.getpid():
+        return
+    forked = hasattr(setup_logging, "pid")
+    setup_logging.pid = os.getpid()
+
+    formatter = logging.Formatter("%(asctime)s %(message)s", "%Y-%m-%d %H:%M:%S")
+    handlers = [StdoutHandler()]
+    if not forked:
+        handlers.append(logging.handlers.RotatingFileHandler(
+                Config.log_file,
+                maxBytes=Config.log_max_bytes,
+                backupCount=Config.log_backups))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    setup_logging.handlers = handlers
+    setup_logging.worker_records = None
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+
+def worker_log_queue():
+    """
+    Returns a multiprocessing queue for setup_worker_logging(). Records put
+    there by worker processes are written by this process
+    """
+    setup_logging()
+    if setup_logging.worker_records is None:
+        records = multiprocessing.Queue()
+        listener = logging.handlers.QueueListener(records, *setup_logging.handlers)
+        listener.start()
+        atexit.register(listener.stop)
+        setup_logging.worker_records = records
+    return setup_logging.worker_records
+
+def setup_worker_logging(records):
+    """
+    In a worker process, e.g. a ProcessPoolExecutor initializer: sends log
+    records to records, a worker_log_queue() of the parent
+    """
+    setup_logging.pid = os.getpid()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+
+def log(level, msg, target=logger):
+    # Skip formatting entirely for disabled levels
+    if not target.isEnabledFor(level):
+        return
+    setup_logging()
+    target.log(level, " ".join(str(tok) for tok in msg))
 
 def trace(*msg):
-    ts = now().strftime("%Y-%m-%d %H:%M:%S")
-    print(ts, *msg)
+    log(logging.INFO, msg)
+
+def debug(*msg):
+    log(logging.DEBUG, msg)
+
+def trace_sql(*msg):
+    log(logging.DEBUG, msg, sql_logger)
 
-    writeFn = handle().write
-    writeFn(ts)
-    for tok in msg:
-        writeFn(" ")
-        writeFn(str(tok))
-    writeFn("\n")
+def human_size(size):
+    """Formats a size in bytes like du -h, e.g. 4.4G"""
+    for unit in ["", "K", "M", "G", "T"]:
+        if size < 1024 or unit == "T":
+            break
+        size /= 1024
+    if not unit:
+        return "%d" % size
+    return ("%.1f%s" if size < 10 else "%.0f%s") % (size, unit)
 
 def run(cmd):
+    start = time.perf_counter()
     try:
         result = subprocess.call(cmd)
     except Exception as exc:
         return None
+    finally:
+        observe_tool(cmd, start)
     return True
 
 def check_output(cmd):
+    start = time.perf_counter()
     try:
         return subprocess.check_output(cmd).decode("utf8")
     except:
         return None
+    finally:
+        observe_tool(cmd, start)
 
 # -----------------------------------------------
 # Flask responses
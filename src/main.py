@@ -1,24 +1,83 @@
 import datetime
 from flask import (
         Flask,
+        g,
         jsonify,
         render_template,
         request,
         send_file,
 )
+import hashlib
 import json
+import mimetypes
 import os
 import re
+import struct
+import tempfile
+import threading
+import time
+import traceback
+from urllib.parse import quote
 from werkzeug.utils import secure_filename
 
 import Config
-from Metadata import Store
+from HashLib import copy_and_hash
+from IngestQueue import IngestQueue
+from Metadata import Metadata
+from MetadataCache import MetadataCache
+import Metrics
 import Search
-from Utils import ErrorResponse
+import Similar
+from Storage import plain
+from StorePool import StorePool
+import Thumbnail
+from Utils import (
+        ErrorResponse,
+        OkayResponse,
+        human_size,
+        trace,
+)
 
 app = Flask("file-browser")
 app.config['UPLOAD_FOLDER'] = Config.upload_dir
 
+store_pool = StorePool()
+metadata_cache = MetadataCache(store_pool)
+ingest_queue = IngestQueue(store_pool, workers=Config.ingest_workers)
+ingest_queue.start()
+similar_index = Similar.SimilarIndex(store_pool.data_version)
+
+Metrics.Gauge("filebrowser_ingest_queue_depth", "Ingest jobs waiting for a worker",
+              ingest_queue.depth)
+Metrics.Gauge("filebrowser_metadata_cache_hits_total", "MetadataCache hits",
+              lambda: metadata_cache.stats()["hits"], "counter")
+Metrics.Gauge("filebrowser_metadata_cache_misses_total", "MetadataCache misses",
+              lambda: metadata_cache.stats()["misses"], "counter")
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    rule = request.url_rule.rule if request.url_rule else "unmatched"
+    Metrics.request_seconds.observe((rule, request.method, response.status_code),
+                                    time.perf_counter() - g.request_start)
+    return response
+
+def reconcile_stats():
+    """Corrects drift in the /db-stats totals every Config.stats_reconcile_interval"""
+    while True:
+        time.sleep(Config.stats_reconcile_interval)
+        try:
+            with store_pool.writer() as store:
+                store.reconcile_stats()
+        except Exception:
+            trace("reconcile_stats failed", traceback.format_exc())
+
+threading.Thread(target=reconcile_stats, name="reconcile-stats",
+                 daemon=True).start()
+
 def page(uploaded_files=[], failed_uploads=[],
         error="",
         message=""):
@@ -43,90 +102,378 @@ def upload():
     success_files = []
     failed_uploads = []
 
-    store = Store()
-    db_all_data = {fd.fname: fd for fd in store.get_db_data()}
+    def name_taken(store, filename):
+        db_row = store.get_db_data_fname(filename)
+        return (db_row and not db_row.deleted) or store.ingest_pending(filename)
 
     uploaded_files = request.files.getlist("files")
     for uploaded_file in uploaded_files:
         filename = secure_filename(uploaded_file.filename)
 
-        db_row = db_all_data.get(filename)
+        # Cheap early rejection. The check that counts is repeated under
+        # the writer below
+        with store_pool.reader() as store:
+            taken = name_taken(store, filename)
+        if taken:
+            print("Duplicate detected", uploaded_file, filename)
+            failed_uploads.append(filename)
+            continue
 
-        if not db_row or db_row.deleted:
-            print("Uploaded:", uploaded_file, "->", filename)
-            local_path = Config.upload_path(filename)
-            uploaded_file.save(local_path)
-            store.process(local_path)
-            success_files.append(filename)
+        # Written under a hidden temporary name so that concurrent uploads
+        # of the same name never write to the same file
+        fd, tmp_path = tempfile.mkstemp(dir=Config.upload_dir, prefix=".upload-")
+        os.close(fd)
+        try:
+            sha256 = copy_and_hash(uploaded_file.stream, tmp_path)
 
-        else:
+            with store_pool.writer() as store:
+                taken = name_taken(store, filename)
+                original = None if taken else store.duplicate_of(sha256)
+                if not taken and not original:
+                    local_path = Config.upload_path(filename)
+                    os.rename(tmp_path, local_path)
+                    tmp_path = None
+                    job_id = store.add_ingest_job(local_path, sha256)
+        finally:
+            # Rejected, or the copy failed (client gone, disk full)
+            if tmp_path:
+                os.remove(tmp_path)
+
+        if taken:
             print("Duplicate detected", uploaded_file, filename)
             failed_uploads.append(filename)
+        elif original:
+            print("Duplicate content", uploaded_file, filename, "same as", original)
+            failed_uploads.append("%s (same as %s)" % (filename, original))
+        else:
+            print("Uploaded:", uploaded_file, "->", filename)
+            ingest_queue.enqueue(job_id)
+            success_files.append((filename, job_id))
 
     return page(
             uploaded_files=success_files,
             failed_uploads=failed_uploads)
 
+@app.route("/ingest-jobs", methods=["GET"])
+def ingest_jobs():
+    """
+    Arguments
+    ---------
+    ids : str
+        Comma separated job ids returned by /upload
+
+    Returns ["OKAY", [[<int:id>, <str:fname>, <str:state>, <str:error>], ...],
+             <int:jobs waiting for a worker>]
+    state is one of queued, running, done or failed
+    """
+    try:
+        job_ids = [int(i) for i in request.args.get("ids", "").split(",") if i]
+    except ValueError:
+        return ErrorResponse("Bad job ids").serialize()
+
+    jobs = ingest_queue.status(job_ids)
+    return OkayResponse([list(job) for job in jobs],
+                        ingest_queue.depth()).serialize()
+
+def sendfile_headers(fname):
+    """Headers handing the upload fname to the front proxy, see Config.sendfile"""
+    if Config.sendfile == "x-sendfile":
+        return {"X-Sendfile": os.path.abspath(Config.upload_path(fname))}
+    if Config.sendfile == "x-accel-redirect":
+        return {"X-Accel-Redirect": Config.sendfile_location + quote(fname)}
+    return None
+
+def send_cached(path, etag, immutable, offload=None, data=None):
+    """
+    send_file with a strong ETag. A matching If-None-Match is answered with
+    304 without opening path. Range requests are answered with 206.
+
+    immutable : bool
+        The URL only ever refers to this content (it has ?v=<hash_sha256>),
+        so the response can be cached forever
+    offload : dict
+        sendfile_headers(). The front proxy sends the file (and handles
+        Range) instead
+    data : bytes
+        Content to send instead of reading path. path only gives the
+        mimetype
+    """
+    mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    elif offload:
+        response = app.response_class(mimetype=mimetype, headers=offload)
+    elif data is not None:
+        response = app.response_class(data, mimetype=mimetype)
+    else:
+        response = send_file(path, etag=etag, conditional=True)
+    response.set_etag(etag)
+    if immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+def thumbnail_size_arg():
+    """The size argument of thumbnail requests. None if it is bad"""
+    try:
+        size = int(request.args.get("size", Thumbnail.default_size()))
+    except ValueError:
+        return None
+    if size not in Config.thumbnail_sizes:
+        return None
+    return size
+
+def thumbnail_names(thumbnail, size):
+    """[(size, name), ...] to try in order for thumbnail in size"""
+    return [(name_size, Thumbnail.sized_name(thumbnail, name_size))
+            for name_size in (size, Thumbnail.default_size())]
+
 @app.route("/thumbnails/<fname>")
 def thumbnail(fname):
-    store = Store()
-    thumb_file = Config.thumbnail_path(fname)
-    if store.metadata.get('*', where={'thumbnail': fname}) and os.path.exists(thumb_file):
-        return send_file(thumb_file, mimetype="image")
+    """
+    Arguments
+    ---------
+    size : int
+        One of Config.thumbnail_sizes. Falls back to the default size if the
+        thumbnail isn't available in that size
+    v : str
+        hash_sha256 of the file. Makes the response cacheable forever
+    """
+    size = thumbnail_size_arg()
+    if size is None:
+        return "404"
+
+    known = metadata_cache.get(
+            ("thumbnail", fname),
+            lambda store: store.metadata.get(['hash_sha256'], where={'thumbnail': fname}))
+    if not known:
+        return "404"
+
+    sha256 = known[0].hash_sha256
+    immutable = request.args.get("v") == sha256
+    for name_size, name in thumbnail_names(fname, size):
+        etag = "%s-%d" % (sha256, name_size)
+        if request.if_none_match.contains_weak(etag):
+            return send_cached(name, etag, immutable)
+        data = Thumbnail.read(name)
+        if data is not None:
+            return send_cached(name, etag, immutable, data=data)
 
     return "404"
 
 @app.route("/get/<fname>")
 def get_file(fname):
-    store = Store()
+    """
+    Arguments
+    ---------
+    v : str
+        hash_sha256 of the file. Makes the response cacheable forever
+    """
     upload_file = Config.upload_path(fname)
-    if store.get_db_data_fname(fname) and os.path.exists(upload_file):
-        return send_file(upload_file)#, mimetype="image")
+    known = metadata_cache.get(
+            ("get", fname),
+            lambda store: store.metadata.get(['hash_sha256'], where={'fname': fname}))
+    if not known:
+        return "404"
+
+    sha256 = known[0].hash_sha256
+    if request.if_none_match.contains_weak(sha256) or os.path.exists(upload_file):
+        return send_cached(upload_file, sha256, request.args.get("v") == sha256,
+                           offload=sendfile_headers(fname))
 
     return "404"
 
-@app.route("/db", methods=["GET"])
-def db_data():
+@app.route("/similar/<fname>", methods=["GET"])
+def similar(fname):
     """
+    Arguments
+    ---------
+    max_distance : int
+        Hamming distance between perceptual hashes, 0 to 64. Defaults to
+        Config.similar_max_distance
+
+    Returns ["OKAY", [[<str:fname>, <int:distance>], ...]] sorted by distance
+    """
+    try:
+        max_distance = int(request.args.get("max_distance",
+                                            Config.similar_max_distance))
+    except ValueError:
+        return ErrorResponse("Bad max_distance").serialize()
+    if not 0 <= max_distance <= 64:
+        return ErrorResponse("Bad max_distance").serialize()
+
+    with store_pool.reader() as store:
+        matches = similar_index.similar(store, fname, max_distance)
+    if matches is None:
+        return ErrorResponse("No perceptual hash for", fname).serialize()
+
+    return OkayResponse([[other, dist] for dist, other in matches]).serialize()
+
+def db_page(args, cols):
+    """
+    Runs the /db page query for the request arguments search, cursor and
+    count. Returns (rows, next_cursor), or ErrorResponse for bad arguments
     """
-    args = request.args
     search = Search.Search(str(args.get('search', '')))
     if search.error_response:
-        return search.error_response.serialize()
-    start = args.get('start', '0')
+        return search.error_response
+    cursor = args.get('cursor') or None
     count = args.get('count', '50')
 
-    try:
-        start = int(start)
-    except:
-        return ErrorResponse("Bad start index")
-
     try:
         count = int(count)
     except:
         return ErrorResponse("Bad count")
+    if not 0 < count <= 1000:
+        return ErrorResponse("Bad count")
 
-    store = Store()
-    filters = {"deleted": False}
-    file_data = store.get_db_data(**filters)
+    def compute(store):
+        clause = search.clause(store.search_indexed) if search.filtering else None
+        try:
+            return store.get_db_page(cursor=cursor,
+                                     count=count,
+                                     deleted=False,
+                                     clause=clause,
+                                     cols=cols)
+        except ValueError as exc:
+            return ErrorResponse(str(exc))
 
-    if search.filtering:
-        file_data = [fd for fd in file_data if search.match(fd)]
+    key = ("db_page", str(args.get('search', '')), cursor, count, tuple(cols))
+    return metadata_cache.get(key, compute)
 
-    return jsonify(file_data[start:start + count])
+@app.route("/db", methods=["GET"])
+def db_data():
+    """
+    Arguments
+    ---------
+    search : str
+    cursor : str
+        Opaque cursor returned with the previous page. Empty for the first page
+    count : int
+        Number of rows per page
+    fields : str
+        Comma separated Metadata columns to return. All columns by default
+
+    Returns ["OKAY", rows, next_cursor]. Each row is a list of values in
+    fields order. next_cursor is null after the last page
+    """
+    args = request.args
+    fields = [f for f in args.get('fields', '').split(",") if f]
+    fields = fields or Metadata.columns()
+    for field in fields:
+        if field not in Metadata.columns():
+            return ErrorResponse("Unknown field", field).serialize()
+
+    page = db_page(args, fields)
+    if isinstance(page, ErrorResponse):
+        return page.serialize()
+
+    file_data, next_cursor = page
+    rows = [[plain(getattr(row, field)) for field in fields]
+            for row in file_data]
+
+    return OkayResponse(rows, next_cursor).serialize()
+
+@app.route("/thumbnail-pack", methods=["GET"])
+def thumbnail_pack():
+    """
+    Thumbnails of every file in a /db page, in one response.
+
+    Arguments
+    ---------
+    search, cursor, count : see /db
+    size : int
+        See /thumbnails
+
+    Returns a 4 byte big endian length N, N bytes of JSON index
+    [[<str:thumbnail>, <int:offset>, <int:length>, <str:mimetype>], ...] and
+    then the thumbnails. Offsets are relative to the end of the index.
+    Thumbnails that can't be read are left out. The ETag changes whenever a
+    file on the page changes
+    """
+    size = thumbnail_size_arg()
+    if size is None:
+        return ErrorResponse("Bad size").serialize()
+
+    page = db_page(request.args, ["thumbnail", "hash_sha256"])
+    if isinstance(page, ErrorResponse):
+        return page.serialize()
+
+    rows = [row for row in page[0] if row.thumbnail]
+    etag = hashlib.sha256(json.dumps(
+            [size] + [[row.thumbnail, row.hash_sha256] for row in rows]).encode("utf8")).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        index, chunks, offset = [], [], 0
+        for row in rows:
+            for _, name in thumbnail_names(row.thumbnail, size):
+                data = Thumbnail.read(name)
+                if data is None:
+                    continue
+                mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                index.append([row.thumbnail, offset, len(data), mimetype])
+                chunks.append(data)
+                offset += len(data)
+                break
+
+        index = json.dumps(index).encode("utf8")
+        response = app.response_class([struct.pack(">I", len(index)), index] + chunks,
+                                      mimetype="application/octet-stream")
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
 
 @app.route("/db-stats", methods=["GET"])
 def db_stats():
-    store = Store()
-    filters = {"deleted": False}
+    """
+    Returns [<str:total size, e.g. 4.4G>, <int:file count>,
+             {"mime_type": {<str:mime type>: [<int:files>, <int:bytes>], ...},
+              "month": {<str:YYYY-MM>: [<int:files>, <int:bytes>], ...}}]
+    """
+    stats = metadata_cache.get(("stats",), lambda store: store.get_stats())
 
+    file_count, size = stats["all"][""]
     return jsonify([
-            Store.upload_dir_disk_usage(),
-            store.metadata.count(where=filters)
+            human_size(size),
+            file_count,
+            {kind: values for kind, values in stats.items() if kind != "all"},
         ])
 
+@app.route("/cache-stats", methods=["GET"])
+def cache_stats():
+    """
+    Returns MetadataCache counters {"hits": ..., "misses": ...,
+    "invalidations": ..., "entries": ..., "max_entries": ..., "bytes": ...,
+    "max_bytes": ...}
+    """
+    return jsonify(metadata_cache.stats())
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Latency histograms and gauges in the Prometheus text format"""
+    return app.response_class(Metrics.render(),
+                              content_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.route("/update-tags", methods=["POST"])
 def update_tags():
+    """
+    POST data is a JSON object
+        add : list(str)
+        remove : list(str)
+        fnames : list(str)
+            Files to modify, or
+        search : str
+            Modify every file matching this search
+        dry_run : bool
+            Only report how many files would be modified
+
+    Returns ["OKAY", <str:message>, <int:file count>]
+    """
     if request.method != "POST":
         return jsonify(["ERROR", "GET not supported"])
 
@@ -138,11 +485,27 @@ def update_tags():
     add_tags = data.get("add", [])
     remove_tags = data.get("remove", [])
     fnames = data.get("fnames", [])
+    search_str = data.get("search")
+    dry_run = bool(data.get("dry_run", False))
+
+    if fnames and search_str is not None:
+        return ErrorResponse("Specify either fnames or search").serialize()
 
-    store = Store()
-    return store.update_tags(fnames, add_tags, remove_tags).serialize()
+    with store_pool.writer() as store:
+        if search_str is not None:
+            search = Search.Search(str(search_str))
+            return store.update_tags_by_search(search, add_tags, remove_tags,
+                                               dry_run=dry_run).serialize()
+        return store.update_tags(fnames, add_tags, remove_tags,
+                                 dry_run=dry_run).serialize()
 
 @app.route("/tags", methods=["GET", "POST"])
 def get_tags():
-    store = Store()
-    return jsonify(store.get_tags())
+    """
+    Returns sorted list of tags. With counts=1, returns [[tag, file_count], ...]
+    """
+    if request.args.get("counts"):
+        counts = metadata_cache.get(("tag_counts",),
+                                    lambda store: store.get_tag_counts())
+        return jsonify([list(row) for row in counts])
+    return jsonify(metadata_cache.get(("tags",), lambda store: store.get_tags()))